@@ -11,25 +11,146 @@ dot_config = dotenv_values(ENV_PATH)
 gitlab_server_url = dot_config.get("GITLAB_SERVER", "https://gitlab.com")
 gitlab_private_token = dot_config.get("GITLAB_PERSONAL_ACCESS_TOKEN", "")
 gitlab_webhook_verify_token = dot_config.get("GITLAB_WEBHOOK_VERIFY_TOKEN", None)
+# keep-alive connections to gitlab in each process
+gitlab_pool_size = int(dot_config.get("GITLAB_POOL_SIZE", "10"))
+# timeout of each gitlab api request
+gitlab_timeout_seconds = float(dot_config.get("GITLAB_TIMEOUT_SECONDS", "30"))
+# cache time of the project labels and bot user, revalidated by etag after it expires
+gitlab_metadata_ttl_seconds = int(dot_config.get("GITLAB_METADATA_TTL_SECONDS", "600"))
+
+# attempts of a gitlab api request that fails with a connection error, 429 or 5xx
+gitlab_retry_attempts = int(dot_config.get("GITLAB_RETRY_ATTEMPTS", "3"))
+gitlab_retry_base_seconds = 0.5
+gitlab_retry_cap_seconds = 8
 
 # Gitlab modifies the maximum number of files
+# only the riskiest files of a larger merge request are reviewed, within the token budget of the triage
 maximum_files = 100
+review_triage_tokens = int(dot_config.get("REVIEW_TRIAGE_TOKENS", "60000"))
+
+# review only the commits pushed since the last review when a reviewed merge request is updated
+incremental_review = dot_config.get("INCREMENTAL_REVIEW", "true").lower() == "true"
+# the newest comments of the reviewers within this many tokens are sent with the diff, 0 means none
+review_discussion_tokens = int(dot_config.get("REVIEW_DISCUSSION_TOKENS", "2000"))
+
+# OpenTelemetry collector to export the traces to by OTLP/HTTP, e.g. http://localhost:4318, empty means no export
+otlp_endpoint = dot_config.get("OTLP_ENDPOINT", "")
+otlp_service_name = dot_config.get("OTLP_SERVICE_NAME", "gitlab-cr-bot")
+
+
+# ------------------Review queue--------------------------
+# number of review workers in each gunicorn worker process
+review_workers = int(dot_config.get("REVIEW_WORKERS", "2"))
+# maximum number of reviews waiting in the queue, shared by all the processes
+review_queue_size = int(dot_config.get("REVIEW_QUEUE_SIZE", "20"))
+# events of a merge request within the quiet window are coalesced into one review
+review_debounce_seconds = float(dot_config.get("REVIEW_DEBOUNCE_SECONDS", "10"))
+# persistent review job queue
+review_job_db = Path(dot_config.get("REVIEW_JOB_DB", ROOT / "data" / "review_jobs.sqlite3"))
+# cheaper reviews go first, a job is scored by the tokens of its diff minus its aging and priority boosts
+# a large merge request gains this many tokens of priority for each minute in the queue, so it can not starve
+review_aging_tokens_per_minute = int(dot_config.get("REVIEW_AGING_TOKENS_PER_MINUTE", "5000"))
+# cost of a review before the diff is fetched
+review_default_cost_tokens = int(dot_config.get("REVIEW_DEFAULT_COST_TOKENS", "8000"))
+# a merge request with one of the labels, or to one of the target branches, is boosted
+review_priority_labels = [
+    label.strip() for label in dot_config.get("REVIEW_PRIORITY_LABELS", "hotfix").split(",") if label.strip()
+]
+review_priority_branches = [
+    branch.strip() for branch in dot_config.get("REVIEW_PRIORITY_BRANCHES", "").split(",") if branch.strip()
+]
+review_priority_boost_tokens = int(dot_config.get("REVIEW_PRIORITY_BOOST_TOKENS", "50000"))
+# a running job is claimed again when its worker does not renew the lease in time
+review_lease_seconds = 120
+# a job that was claimed too many times (e.g. it kills its worker) is marked as failed
+review_max_attempts = 3
+# finished jobs are kept for a week
+review_job_retention_seconds = 7 * 24 * 3600
+
+
+# retries and backoff time that all the gitlab and LLM calls of a review may spend together
+review_retry_budget = int(dot_config.get("REVIEW_RETRY_BUDGET", "10"))
+review_retry_budget_seconds = float(dot_config.get("REVIEW_RETRY_BUDGET_SECONDS", "300"))
+# calls to gitlab or the LLM fail at once after this many consecutive failures,
+# until a probe succeeds after the recovery time
+circuit_failure_threshold = int(dot_config.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+circuit_recovery_seconds = float(dot_config.get("CIRCUIT_RECOVERY_SECONDS", "30"))
 
 
 # ------------------GPT info--------------------------
 # api impl
-llm_api_impl = "llm_api.llm_api_ollama.LLMApiOllama"
+# - llm_api.llm_api_ollama.LLMApiOllama: one ollama server
+# - llm_api.llm_api_ollama_cluster.LLMApiOllamaCluster: load balance over the ollama servers in LLM_API_BASE
+llm_api_impl = dot_config.get("LLM_API_IMPL", "llm_api.llm_api_ollama.LLMApiOllama")
 
 api_config = {
     "MODEL_NAME": dot_config.get("LLM_MODEL_NAME", "deepseek-r1:70b"),
     "PROVIDER": "ollama",
+    # comma separated servers for LLMApiOllamaCluster
     "API_BASE": dot_config.get("LLM_API_BASE", None),
     # http proxy for llm requests
     "LLM_PROXY": dot_config.get("LLM_HTTP_PROXY", None),
     # number of context tokens for ollama
-    "NUM_CTX": "32768",
+    "NUM_CTX": dot_config.get("LLM_NUM_CTX", "32768"),
+    # health check of LLMApiOllamaCluster: probe interval, failures to eject a server, minimum ejection time
+    "HEALTH_INTERVAL": dot_config.get("LLM_HEALTH_INTERVAL", "15"),
+    "MAX_FAILURES": dot_config.get("LLM_MAX_FAILURES", "3"),
+    "EJECT_SECONDS": dot_config.get("LLM_EJECT_SECONDS", "60"),
 }
 
+# tokens reserved in the context window for the output, including the reasoning content
+llm_output_reserve_tokens = int(dot_config.get("LLM_OUTPUT_RESERVE_TOKENS", "8192"))
+# stream the output of the model, the reasoning content is dropped while it is generated
+llm_stream = dot_config.get("LLM_STREAM", "true").lower() == "true"
+# a generation is stopped when it exceeds the output tokens or the time limit
+llm_max_output_tokens = int(dot_config.get("LLM_MAX_OUTPUT_TOKENS", llm_output_reserve_tokens))
+llm_deadline_seconds = float(dot_config.get("LLM_DEADLINE_SECONDS", "900"))
+# attempts of a generation that fails with a connection error or a 5xx of the LLM server
+llm_retry_attempts = int(dot_config.get("LLM_RETRY_ATTEMPTS", "3"))
+llm_retry_base_seconds = 5
+llm_retry_cap_seconds = 60
+# generations running at the same time on each backend, shared by all the processes of the host
+llm_max_concurrency = int(dot_config.get("LLM_MAX_CONCURRENCY", "2"))
+# limits of specific backends, e.g. http://gpu1:11434=4,http://gpu2:11434=1
+llm_backend_concurrency = dot_config.get("LLM_BACKEND_CONCURRENCY", "")
+# lock files of the generation slots
+llm_admission_dir = Path(dot_config.get("LLM_ADMISSION_DIR", ROOT / "data" / "llm_slots"))
+# a call fails when it waits longer than this for a slot
+llm_admission_timeout_seconds = float(dot_config.get("LLM_ADMISSION_TIMEOUT_SECONDS", "1800"))
+# tokenizer to measure the prompt, fall back to the heuristic tokenizer if it is not available
+tokenizer_impl = dot_config.get("TOKENIZER", "service.token_budget.HeuristicTokenizer")
+
+# review mode
+# - auto: review the merge request in as few calls as the context window allows,
+#         the chunks of a large one are reviewed in parallel and merged
+# - single: always review the whole merge request in one call
+review_mode = dot_config.get("REVIEW_MODE", "auto")
+# number of chunks reviewed at the same time
+review_map_fanout = int(dot_config.get("REVIEW_MAP_FANOUT", "4"))
+
+# changes which are not worth a review are dropped before they are sent to the LLM
+# paths to skip, a glob without a slash matches the file name, a glob with a slash matches in any directory
+review_ignore_globs = [
+    "*.lock", "package-lock.json", "pnpm-lock.yaml", "go.sum", "*.min.js", "*.min.css", "*.map",
+    "*_pb2.py", "*_pb2_grpc.py", "*.pb.go", "*.snap", "__snapshots__/*", "vendor/*", "node_modules/*",
+] + [glob.strip() for glob in dot_config.get("REVIEW_IGNORE_GLOBS", "").split(",") if glob.strip()]
+# skip the files which look generated or minified
+review_skip_generated = dot_config.get("REVIEW_SKIP_GENERATED", "true").lower() == "true"
+# the diff of a file is cut to this many tokens, 0 means unlimited
+review_max_file_tokens = int(dot_config.get("REVIEW_MAX_FILE_TOKENS", "8000"))
+
+# the enclosing function or block of each changed hunk is sent with the diff, 0 tokens means no context
+review_context_tokens = int(dot_config.get("REVIEW_CONTEXT_TOKENS", "4000"))
+review_context_file_tokens = int(dot_config.get("REVIEW_CONTEXT_FILE_TOKENS", "1000"))
+# files fetched at the same time for the context, and file contents cached in each process
+review_context_concurrency = int(dot_config.get("REVIEW_CONTEXT_CONCURRENCY", "4"))
+review_context_cache_entries = int(dot_config.get("REVIEW_CONTEXT_CACHE_ENTRIES", "256"))
+
+# cache of the reviews, the same diff is not reviewed twice by the same model and prompt
+review_cache_db = Path(dot_config.get("REVIEW_CACHE_DB", ROOT / "data" / "review_cache.sqlite3"))
+review_cache_ttl_seconds = int(dot_config.get("REVIEW_CACHE_TTL_SECONDS", 14 * 24 * 3600))
+review_cache_max_entries = int(dot_config.get("REVIEW_CACHE_MAX_ENTRIES", "5000"))
+
 # Prompt
 gpt_message = """
 你是一位资深编程专家，gitlab的分支代码变更将以git diff形式提供，请你帮忙review本段代码。
@@ -91,3 +212,16 @@ gpt_message = """
 {审核结论}
 """
 
+
+# Prompt to merge the reviews of the chunks in map-reduce mode
+gpt_reduce_message = """
+你是一位资深编程专家，一次gitlab合并请求的代码变更过大，已被拆分为多个部分分别review。
+下面将提供各部分的review结果，请你将它们合并为一份完整的review。
+
+必须要求：
+1. 合并重复的改动内容和问题点，不要遗漏任何一个部分提出的问题点。
+2. 评分需要综合所有部分给出，而不是简单平均。
+3. 审核结论需要基于整个合并请求给出。
+4. 返回格式与各部分的review结果完全相同，以 `## CR Bot 审核结果` 为标题。
+5. 用中文书写。
+"""
@@ -1,45 +1,94 @@
 import threading
 
 from flask import jsonify
-from retrying import retry
 
-from service.chat_review import review_code_for_mr
-from service.gitlab_api import LABEL_DONE, LABEL_FAILED, LABEL_WIP, create_project_labels, get_user_id, set_label_wip
+from config.config import incremental_review, review_priority_branches, review_priority_labels
+from service.gitlab_api import (
+    LABEL_DONE,
+    LABEL_FAILED,
+    LABEL_WIP,
+    create_project_labels,
+    get_cached_user_id,
+    set_label_busy
+)
+from service.review_queue import review_queue
 from utils.logger import log
+from utils.metrics import WEBHOOK_EVENTS
+from utils.tracing import current_trace_id
 
 
 def handle_mr_request(gitlab_payload: dict):
     """
-    Handle a merge request event from GitLab
+    Handle a merge request event from GitLab.
+    Only in-memory checks are done here, all the GitLab requests are done by the review worker.
     """
     attr: dict = gitlab_payload.get("object_attributes")
     project_id = attr.get("target_project_id")
     mr_id = attr["iid"]
 
+    # 0. The review of a closed or merged mr is useless
+    if attr.get("action") in ("close", "merge") or attr.get("state") in ("closed", "merged"):
+        review_queue.cancel(project_id, mr_id)
+        WEBHOOK_EVENTS.labels("closed").inc()
+        return jsonify({'status': 'success'}), 200
+
     labels = [
         label["title"] if isinstance(label, dict) else label
         for label in attr.get("labels", [])
     ]
 
+    # new commits are pushed: a running review is superseded, a reviewed mr is reviewed again
+    pushed = attr.get("action") == "update" and attr.get("oldrev") is not None
+
     # 1. Check reviewer id, draft status, and the mr label
-    if (
-        get_user_id() not in attr.get("reviewer_ids") or 
-        attr.get("draft") or
-        (
-            LABEL_WIP in labels or
-            LABEL_DONE in labels or
-            LABEL_FAILED in labels
-        )
+    # the bot user id is fetched when the review workers start,
+    # the reviewer id is checked again by the review worker if it is not fetched yet
+    user_id = get_cached_user_id()
+    filtered = None
+    if user_id is not None and user_id not in (attr.get("reviewer_ids") or []):
+        filtered = "not_reviewer"
+    elif attr.get("draft"):
+        filtered = "draft"
+    elif (
+        (LABEL_WIP in labels and not pushed) or
+        (LABEL_DONE in labels and not (incremental_review and pushed)) or
+        LABEL_FAILED in labels
     ):
+        filtered = "labeled"
+    if filtered is not None:
+        WEBHOOK_EVENTS.labels(filtered).inc()
         return jsonify({'status': 'success'}), 200
 
-    # 2. Create the project label if necessary
-    create_project_labels(project_id)
-    set_label_wip(project_id, mr_id)
+    log.info("Trigger cr bot handler for mr: %s!%s", project_id, mr_id)
 
-    log.info("Trigger cr bot handler for mr: ", gitlab_payload)
-
-    thread = threading.Thread(target=review_code_for_mr, args=(project_id, mr_id, gitlab_payload))
-    thread.start()
+    # 2. Put the review into the queue, mark the mr as busy if the queue is full
+    head_sha = (attr.get("last_commit") or {}).get("id")
+    priority = review_priority(labels, attr.get("target_branch"))
+    submitted = review_queue.submit(
+        project_id, mr_id, gitlab_payload, head_sha=head_sha, priority=priority, trace_id=current_trace_id()
+    )
+    if not submitted:
+        # the busy label is only for the mrs the bot is known to review
+        if user_id is not None:
+            threading.Thread(target=mark_busy, args=(project_id, mr_id), daemon=True).start()
+        WEBHOOK_EVENTS.labels("busy").inc()
+        return jsonify({'status': 'busy'}), 200
 
+    WEBHOOK_EVENTS.labels("accepted").inc()
     return jsonify({'status': 'success'}), 200
+
+
+def review_priority(labels: list[str], target_branch: str | None) -> int:
+    """
+    Number of priority boosts of a merge request, by its labels and target branch
+    """
+    return int(any(label in review_priority_labels for label in labels)) + \
+        int(target_branch in review_priority_branches)
+
+
+def mark_busy(project_id: int, mr_id: int):
+    try:
+        create_project_labels(project_id)
+        set_label_busy(project_id, mr_id)
+    except Exception as e:
+        log.error(f"Set busy label for mr: {project_id}!{mr_id} failed: {e}")
@@ -1,24 +1,72 @@
 import json
+import time
 from os import abort
 from flask import Blueprint, request, jsonify
 from app.gitlab_utils import handle_mr_request
 from config.config import gitlab_webhook_verify_token
-from utils.logger import log
+from llm_api.load_api import get_llm_api
+from service.chat_review import context_enricher, llm_breaker, preprocessor, review_cache
+from service.gitlab_client import gitlab
+from service.project_cache import metadata_cache
+from service.review_queue import review_queue
+from utils.latency import LatencyRecorder
+from utils.logger import Truncated, log
+from utils.metrics import WEBHOOK_EVENTS, WEBHOOK_LATENCY
+from utils.tracing import trace
 
 git = Blueprint('git', __name__)
 
+webhook_latency = LatencyRecorder()
+
 
 @git.route('/ping', methods=['GET'])
 def ping():
     return jsonify({'status': 'success'}), 200
 
 
+@git.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'status': 'success',
+        'webhook_latency': webhook_latency.stats(),
+        'queue': review_queue.stats(),
+        'review_cache': review_cache.stats(),
+        'preprocess': preprocessor.stats(),
+        'context': context_enricher.stats(),
+        'gitlab': gitlab.stats(),
+        'gitlab_metadata_cache': metadata_cache.stats(),
+        'llm': llm_stats(),
+    }), 200
+
+
+def llm_stats() -> dict:
+    api = get_llm_api()
+    return {
+        'backends': api.stats() if hasattr(api, 'stats') else {},
+        'admission': api.admission_stats() if hasattr(api, 'admission_stats') else {},
+        'circuit': llm_breaker.stats(),
+    }
+
+
 @git.route('/webhook', methods=['GET', 'POST'])
 def webhook():
+    start = time.monotonic()
+    try:
+        # the reviews queued by the webhook continue its trace
+        with trace("webhook", summary=False):
+            return handle_webhook()
+    finally:
+        elapsed = time.monotonic() - start
+        webhook_latency.record(elapsed)
+        WEBHOOK_LATENCY.observe(elapsed)
+
+
+def handle_webhook():
     # check verify token if it is set
     if gitlab_webhook_verify_token is not None:
         webhook_token = request.headers.get('X-Gitlab-Token')
         if webhook_token != gitlab_webhook_verify_token:
+            WEBHOOK_EVENTS.labels("bad_token").inc()
             return jsonify({'status': 'bad verify token'}), 401
 
     if request.method == 'GET':
@@ -27,7 +75,7 @@ def webhook():
     elif request.method == 'POST':
         gitlab_payload = request.data.decode('utf-8')
         gitlab_payload = json.loads(gitlab_payload)
-        log.debug(f"🌈 : {gitlab_payload}")
+        log.debug("🌈 : %s", Truncated(gitlab_payload))
         event_type = gitlab_payload.get('object_kind')
 
         if event_type == 'merge_request':
@@ -35,6 +83,7 @@ def webhook():
             return handle_mr_request(gitlab_payload)
         else:
             log.error("Not support event type")
+            WEBHOOK_EVENTS.labels("unsupported_event").inc()
             return jsonify({'status': 'success'}), 200
 
     else:
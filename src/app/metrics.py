@@ -0,0 +1,26 @@
+from flask import Blueprint, Response
+from prometheus_client.core import GaugeMetricFamily
+
+from service.job_store import STATUS_ENQUEUED, STATUS_RUNNING, job_store
+from utils.metrics import registry, render
+
+metrics = Blueprint('metrics', __name__)
+
+
+class QueueCollector:
+    """
+    Depth of the review queue, read from the job store shared by all the processes when it is scraped
+    """
+
+    def collect(self):
+        counts = job_store.counts()
+        jobs = GaugeMetricFamily("crbot_review_queue_jobs", "Review jobs waiting or running", labels=["status"])
+        for status in (STATUS_ENQUEUED, STATUS_RUNNING):
+            jobs.add_metric([status], counts[status])
+        yield jobs
+
+
+@metrics.route('/metrics', methods=['GET'])
+def scrape():
+    body, content_type = render(registry(QueueCollector()))
+    return Response(body, content_type=content_type)
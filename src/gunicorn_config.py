@@ -1,7 +1,19 @@
 import os
 import multiprocessing
+from pathlib import Path
 
 preload_app = True
+
+# the prometheus metrics of all the workers are aggregated from this directory,
+# it must be set before prometheus_client is imported by the preloaded app
+prometheus_multiproc_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', (Path(__file__).parent.parent / 'data' / 'prometheus').as_posix()
+)
+# the preloaded app creates its metric files before any server hook is called,
+# so the directory is prepared here, and the metrics of the last run are stale
+os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+for stale in Path(prometheus_multiproc_dir).glob('*.db'):
+    stale.unlink(missing_ok=True)
 bind = "0.0.0.0:8000"
 
 gunicorn_workers = os.environ.get('GUNICORN_WORKERS', 'auto')
@@ -26,3 +38,16 @@ proc_name = 'gunicorn.pid'
 pidfile = 'app_run.log'
 loglevel = 'info'
 logfile = 'logs/gunicorn.log'
+
+
+def child_exit(server, worker):
+    # the counters of a dead worker are kept, its gauges are dropped
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # start the review workers, the pending reviews are resumed after a restart,
+    # the threads must start after the gevent worker patched the threading module in init_process
+    from service.review_queue import review_queue
+    review_queue.start()
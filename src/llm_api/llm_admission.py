@@ -0,0 +1,162 @@
+import fcntl
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from config.config import llm_admission_dir, llm_admission_timeout_seconds, llm_backend_concurrency, llm_max_concurrency
+from llm_api.llm_api_interface import LLMApiError
+from utils.logger import log
+from utils.tracing import record_span
+
+
+class AdmissionController:
+    """
+    Cap the in-flight generations of each LLM backend across all the processes of a host.
+    A slot is a flock on one of the slot files of the backend, the kernel releases it if the process dies.
+    The waiters are admitted in the order they arrive, only the head of the wait queue may take a free slot.
+    The locks are polled without blocking, so a waiting gevent worker keeps serving the other greenlets.
+    """
+
+    def __init__(self, directory: Path, default_limit: int, limits: dict[str, int],
+                 timeout_seconds: float, poll_seconds: float = 0.2):
+        self.directory = Path(directory)
+        self.default_limit = default_limit
+        self.limits = limits
+        self.timeout_seconds = timeout_seconds
+        self.poll_seconds = poll_seconds
+
+    def limit_of(self, backend: str) -> int:
+        return self.limits.get(backend, self.default_limit)
+
+    def _path(self, backend: str, suffix: str) -> Path:
+        name = hashlib.sha1(backend.encode()).hexdigest()[:16]
+        return self.directory / f"{name}.{suffix}"
+
+    @contextmanager
+    def _queue(self, backend: str) -> Iterator[dict]:
+        """
+        Read and write the wait queue of the backend under its lock.
+        The lock is held only to update a small file, so a blocking flock is fine here.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self._path(backend, "queue"), "a+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.seek(0)
+                content = file.read()
+                state = json.loads(content) if content else {"next": 0, "waiters": []}
+                # a process that died while it was waiting must not block the queue
+                state["waiters"] = [waiter for waiter in state["waiters"] if _alive(waiter[1])]
+                yield state
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps(state))
+                file.flush()
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _try_slot(self, backend: str):
+        for index in range(self.limit_of(backend)):
+            file = open(self._path(backend, f"slot{index}"), "a")
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                continue
+            return file
+        return None
+
+    @contextmanager
+    def slot(self, backend: str) -> Iterator[float]:
+        """
+        Hold a generation slot of the backend, raise LLMApiError if no slot is free in time
+        :param backend: backend name, e.g. the url of the ollama server
+        :return: the time waited for the slot
+        """
+        start = time.monotonic()
+        with self._queue(backend) as state:
+            ticket = state["next"]
+            state["next"] += 1
+            state["waiters"].append([ticket, os.getpid()])
+
+        file = None
+        try:
+            while file is None:
+                with self._queue(backend) as state:
+                    if state["waiters"] and state["waiters"][0][0] == ticket:
+                        file = self._try_slot(backend)
+                        if file is not None:
+                            state["waiters"].pop(0)
+                        waiting = 0
+                    else:
+                        waiting = next((i for i, waiter in enumerate(state["waiters"]) if waiter[0] == ticket), 0)
+                if file is not None:
+                    break
+                if time.monotonic() - start > self.timeout_seconds:
+                    raise LLMApiError(f"No free slot of {backend} in {self.timeout_seconds:.0f}s, "
+                                      f"{waiting} waiters ahead")
+                time.sleep(self.poll_seconds)
+        except BaseException:
+            if file is None:
+                with self._queue(backend) as state:
+                    state["waiters"] = [waiter for waiter in state["waiters"] if waiter[0] != ticket]
+            raise
+
+        waited = time.monotonic() - start
+        record_span("llm.slot_wait", start, start + waited, backend=backend)
+        if waited > 1:
+            log.info(f"Waited {waited:.1f}s for a slot of {backend}")
+        try:
+            yield waited
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+            file.close()
+
+    def stats(self, backend: str) -> dict:
+        in_flight = 0
+        for index in range(self.limit_of(backend)):
+            path = self._path(backend, f"slot{index}")
+            if not path.exists():
+                continue
+            with open(path, "a") as file:
+                try:
+                    fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    in_flight += 1
+                    continue
+                fcntl.flock(file, fcntl.LOCK_UN)
+        with self._queue(backend) as state:
+            waiting = len(state["waiters"])
+        return {"limit": self.limit_of(backend), "in_flight": in_flight, "waiting": waiting}
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def parse_limits(value: str) -> dict[str, int]:
+    """
+    Parse the limits of the backends, e.g. http://gpu1:11434=4,http://gpu2:11434=1
+    """
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        backend, _, limit = item.strip().rpartition("=")
+        limits[backend] = int(limit)
+    return limits
+
+
+llm_admission = AdmissionController(
+    llm_admission_dir, llm_max_concurrency, parse_limits(llm_backend_concurrency), llm_admission_timeout_seconds
+)
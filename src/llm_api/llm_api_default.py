@@ -1,9 +1,6 @@
-import os
 from math import trunc
 
-from config.config import api_config as out_config
 from llm_api.llm_api_interface import LLMApiInterface
-from llm_api.load_api import create_llm_api_instance
 from unionllm import unionchat
 
 
@@ -17,18 +14,14 @@ class LLMApiDefault(LLMApiInterface):
         self.num_ctx = None
 
     def set_config(self, api_config: dict) -> bool:
-        if api_config is None:
-            raise ValueError("api_config is None")
-        for key in api_config:
-            if key == "MODEL_NAME":
-                self.model_name = api_config[key]
-            if key == "PROVIDER":
-                self.provider = api_config[key]
-            os.environ[key] = api_config[key]
-        
+        # the config is not written to os.environ, it is shared by the concurrent reviews
+        api_config = self._freeze_config(api_config)
+        self.model_name = api_config.get("MODEL_NAME")
+        self.provider = api_config.get("PROVIDER")
+
         if self.provider == "ollama":
-            self.api_base = os.getenv("API_BASE", None)
-            self.num_ctx = int(os.getenv("NUM_CTX", "8192"))
+            self.api_base = api_config.get("API_BASE", None)
+            self.num_ctx = int(api_config.get("NUM_CTX", "8192"))
 
         return True
 
@@ -50,3 +43,6 @@ class LLMApiDefault(LLMApiInterface):
 
     def get_respond_tokens(self) -> int:
         return trunc(int(self.response['usage']['total_tokens']))
+
+    def get_prompt_tokens(self) -> int:
+        return int(self.response['usage'].get('prompt_tokens') or 0)
@@ -1,16 +1,48 @@
+import threading
 from abc import ABC, abstractmethod
+from types import MappingProxyType
+from typing import Iterator, Mapping
 
 
 class LLMApiError(Exception):
-    def __init__(self, inner: Exception):
+    def __init__(self, inner: Exception | str, retryable: bool = False):
+        """
+        :param inner: 原始错误
+        :param retryable: 是否为暂时性错误（连接失败、服务端 5xx 等），重试可能成功
+        """
         super().__init__(str(inner))
         self.inner = inner
+        self.retryable = retryable
 
     def __str__(self):
         return f"LLM API error: {self.inner}"
 
 
 class LLMApiInterface(ABC):
+    """
+    一个实例在进程内被多个线程共享：配置在 set_config 后不可修改，返回结果按线程保存
+    """
+
+    @property
+    def response(self):
+        """当前线程最近一次的模型返回结果"""
+        return getattr(self._thread_local(), "response", None)
+
+    @response.setter
+    def response(self, value):
+        self._thread_local().response = value
+
+    def _thread_local(self) -> threading.local:
+        return self.__dict__.setdefault("_local", threading.local())
+
+    def _freeze_config(self, api_config: dict) -> Mapping:
+        """保存不可修改的配置，一个实例只能设置一次配置"""
+        if api_config is None:
+            raise ValueError("api_config is None")
+        if self.__dict__.get("config") is not None:
+            raise ValueError("The config of an LLM api instance is immutable, create a new instance instead")
+        self.config = MappingProxyType(dict(api_config))
+        return self.config
 
     @abstractmethod
     def set_config(self, api_config: dict) -> bool:
@@ -22,6 +54,17 @@ class LLMApiInterface(ABC):
         """根据提示生成文本"""
         pass
 
+    def stream_text(self, messages: list, max_tokens: int | None = None,
+                    deadline: float | None = None) -> Iterator[str]:
+        """
+        流式生成文本，逐段返回模型输出
+        :param max_tokens: 最大输出token数
+        :param deadline: time.monotonic() 截止时间，超时抛出 LLMApiError
+        默认实现不支持流式，一次性返回全部内容
+        """
+        self.generate_text(messages)
+        yield self.get_respond_content()
+
     @abstractmethod
     def get_respond_content(self) -> str:
         """获取模型返回内容"""
@@ -30,4 +73,8 @@ class LLMApiInterface(ABC):
     @abstractmethod
     def get_respond_tokens(self) -> int:
         """获取模型返回token数"""
-        pass
\ No newline at end of file
+        pass
+
+    def get_prompt_tokens(self) -> int:
+        """获取提示token数，不支持时返回0"""
+        return 0
\ No newline at end of file
@@ -1,10 +1,23 @@
+import time
 from math import trunc
+from typing import Iterator
 
-from ollama import Client
+import httpx
+from ollama import Client, ResponseError
 
+from llm_api.llm_admission import llm_admission
 from llm_api.llm_api_interface import LLMApiInterface, LLMApiError
 
 
+def is_retryable_error(e: Exception) -> bool:
+    """
+    Connection failures and 429 or 5xx of the server are transient, the deadline of a generation is not
+    """
+    if isinstance(e, ResponseError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, (httpx.TransportError, ConnectionError))
+
+
 class LLMApiOllama(LLMApiInterface):
 
     def __init__(self):
@@ -16,9 +29,8 @@ class LLMApiOllama(LLMApiInterface):
         self.proxy = None
 
     def set_config(self, api_config: dict) -> bool:
-        if api_config is None:
-            raise ValueError("api_config is None")
-        
+        api_config = self._freeze_config(api_config)
+
         self.provider = api_config.get("PROVIDER", "")
         if self.provider != "ollama":
             raise ValueError("The provider must be ollama")
@@ -37,19 +49,70 @@ class LLMApiOllama(LLMApiInterface):
 
         return True
 
+    @property
+    def backend(self) -> str:
+        return self.api_base or "ollama"
+
     def generate_text(self, messages: list) -> bool:
+        with llm_admission.slot(self.backend):
+            try:
+                self.response = self.client.chat(
+                    model=self.model_name,
+                    messages=messages,
+                    options={"num_ctx": self.num_ctx}
+                )
+            except Exception as e:
+                raise LLMApiError(e, retryable=is_retryable_error(e))
+        return True
+
+    def stream_text(self, messages: list, max_tokens: int | None = None,
+                    deadline: float | None = None) -> Iterator[str]:
+        options = {"num_ctx": self.num_ctx}
+        if max_tokens:
+            options["num_predict"] = max_tokens
+        with llm_admission.slot(self.backend) as waited:
+            # the time waiting for a slot does not count towards the deadline
+            if deadline is not None:
+                deadline += waited
+            yield from self._stream(messages, options, deadline)
+
+    def _stream(self, messages: list, options: dict, deadline: float | None) -> Iterator[str]:
         try:
-            self.response = self.client.chat(
-                model=self.model_name, 
+            stream = self.client.chat(
+                model=self.model_name,
                 messages=messages,
-                options={"num_ctx": self.num_ctx}
+                options=options,
+                stream=True
             )
         except Exception as e:
-            raise LLMApiError(e)
-        return True
+            raise LLMApiError(e, retryable=is_retryable_error(e))
+
+        try:
+            for part in stream:
+                if part.get("done"):
+                    # the last part has the token counts but no content
+                    self.response = part
+                content = part["message"]["content"]
+                if content:
+                    yield content
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError("Generation exceeds the deadline")
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            raise LLMApiError(e, retryable=is_retryable_error(e))
+        finally:
+            # closing the stream closes the connection, ollama stops the generation
+            stream.close()
+
+    def admission_stats(self) -> dict:
+        return {self.backend: llm_admission.stats(self.backend)}
 
     def get_respond_content(self) -> str:
         return self.response['message']['content']
 
     def get_respond_tokens(self) -> int:
         return trunc(int(self.response['eval_count']))
+
+    def get_prompt_tokens(self) -> int:
+        return int(self.response.get('prompt_eval_count') or 0)
@@ -0,0 +1,251 @@
+import os
+import threading
+import time
+from math import trunc
+from typing import Iterator
+
+from ollama import Client
+
+from llm_api.llm_admission import llm_admission
+from llm_api.llm_api_interface import LLMApiInterface, LLMApiError
+from llm_api.llm_api_ollama import is_retryable_error
+from utils.logger import log
+
+
+class _Endpoint:
+
+    def __init__(self, host: str, proxy: str | None):
+        self.host = host
+        self.client = Client(host=host, proxy=proxy)
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_at = None
+        self.requests = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.tokens = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_at is None
+
+
+class LLMApiOllamaCluster(LLMApiInterface):
+    """
+    Ollama backend load balanced over several servers, API_BASE is a comma separated list of them.
+    A request goes to the healthy server with the fewest outstanding requests, and fails over to another one.
+    A server is ejected after consecutive failures,
+    and admitted again when a health probe succeeds after the ejection time.
+    """
+
+    def __init__(self):
+        self.model_name = None
+        self.response = None
+        self.provider = None
+        self.num_ctx = None
+        self.health_interval = None
+        self.max_failures = None
+        self.eject_seconds = None
+        self.endpoints: list[_Endpoint] = []
+        self._lock = threading.Lock()
+        self._health_pid = None
+
+    def set_config(self, api_config: dict) -> bool:
+        api_config = self._freeze_config(api_config)
+
+        self.provider = api_config.get("PROVIDER", "")
+        if self.provider != "ollama":
+            raise ValueError("The provider must be ollama")
+
+        self.model_name = api_config.get("MODEL_NAME", "")
+        self.num_ctx = int(api_config.get("NUM_CTX", "8192"))
+        self.health_interval = float(api_config.get("HEALTH_INTERVAL", "15"))
+        self.max_failures = int(api_config.get("MAX_FAILURES", "3"))
+        self.eject_seconds = float(api_config.get("EJECT_SECONDS", "60"))
+
+        hosts = [host.strip() for host in (api_config.get("API_BASE") or "").split(",") if host.strip()]
+        if not hosts:
+            raise ValueError("API_BASE must be a comma separated list of ollama servers")
+        proxy = api_config.get("LLM_PROXY", None)
+        self.endpoints = [_Endpoint(host, proxy) for host in hosts]
+
+        return True
+
+    def _acquire(self, tried: set[str]) -> _Endpoint:
+        """
+        Pick the healthy endpoint with the fewest outstanding requests,
+        the endpoint ejected first if none is healthy
+        """
+        self._ensure_health_checker()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.host not in tried]
+            healthy = [endpoint for endpoint in candidates if endpoint.healthy]
+            if healthy:
+                endpoint = min(healthy, key=lambda e: e.outstanding)
+            else:
+                endpoint = min(candidates, key=lambda e: e.ejected_at)
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def _release(self, endpoint: _Endpoint, elapsed: float, tokens: int = 0, error: Exception | None = None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.latency_total += elapsed
+            endpoint.tokens += tokens
+            if error is None:
+                endpoint.failures = 0
+                return
+            endpoint.errors += 1
+        log.warning(f"Ollama {endpoint.host} failed in {elapsed:.1f}s: {error}")
+        self._record_failure(endpoint)
+
+    def _record_failure(self, endpoint: _Endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            if endpoint.failures < self.max_failures or not endpoint.healthy:
+                return
+            endpoint.ejected_at = time.monotonic()
+        log.error(f"Eject ollama {endpoint.host} for at least {self.eject_seconds:.0f}s "
+                  f"after {endpoint.failures} consecutive failures")
+
+    def _ensure_health_checker(self):
+        with self._lock:
+            if self._health_pid == os.getpid():
+                return
+            self._health_pid = os.getpid()
+        threading.Thread(target=self._check_health, name="ollama-health", daemon=True).start()
+
+    def _check_health(self):
+        while True:
+            time.sleep(self.health_interval)
+            for endpoint in self.endpoints:
+                try:
+                    # listing the running models is cheap, it does not load any model
+                    endpoint.client.ps()
+                except Exception as e:
+                    log.warning(f"Health probe of ollama {endpoint.host} failed: {e}")
+                    self._record_failure(endpoint)
+                    continue
+                with self._lock:
+                    readmitted = (
+                        not endpoint.healthy and
+                        time.monotonic() - endpoint.ejected_at >= self.eject_seconds
+                    )
+                    if readmitted:
+                        endpoint.ejected_at = None
+                    if endpoint.healthy:
+                        endpoint.failures = 0
+                if readmitted:
+                    log.info(f"Admit ollama {endpoint.host} again")
+
+    def generate_text(self, messages: list) -> bool:
+        tried, last_error = set(), None
+        for _ in self.endpoints:
+            endpoint = self._acquire(tried)
+            tried.add(endpoint.host)
+            admitted, start = False, time.monotonic()
+            try:
+                with llm_admission.slot(endpoint.host):
+                    admitted, start = True, time.monotonic()
+                    response = endpoint.client.chat(
+                        model=self.model_name,
+                        messages=messages,
+                        options={"num_ctx": self.num_ctx}
+                    )
+            except Exception as e:
+                if not admitted:
+                    # no free slot in time, it is not a failure of the server
+                    self._release(endpoint, 0.0)
+                    raise
+                self._release(endpoint, time.monotonic() - start, error=e)
+                last_error = e
+                continue
+            self._release(endpoint, time.monotonic() - start, tokens=response.get("eval_count") or 0)
+            self.response = response
+            return True
+        raise LLMApiError(last_error, retryable=is_retryable_error(last_error))
+
+    def stream_text(self, messages: list, max_tokens: int | None = None,
+                    deadline: float | None = None) -> Iterator[str]:
+        options = {"num_ctx": self.num_ctx}
+        if max_tokens:
+            options["num_predict"] = max_tokens
+
+        tried, last_error = set(), None
+        for _ in self.endpoints:
+            endpoint = self._acquire(tried)
+            tried.add(endpoint.host)
+            admitted, start = False, time.monotonic()
+            started, tokens, stream = False, 0, None
+            try:
+                with llm_admission.slot(endpoint.host) as waited:
+                    admitted, start = True, time.monotonic()
+                    # the time waiting for a slot does not count towards the deadline
+                    endpoint_deadline = deadline + waited if deadline is not None else None
+                    stream = endpoint.client.chat(
+                        model=self.model_name,
+                        messages=messages,
+                        options=options,
+                        stream=True
+                    )
+                    for part in stream:
+                        if part.get("done"):
+                            self.response = part
+                            tokens = part.get("eval_count") or 0
+                        content = part["message"]["content"]
+                        if content:
+                            started = True
+                            yield content
+                        if endpoint_deadline is not None and time.monotonic() > endpoint_deadline:
+                            raise TimeoutError("Generation exceeds the deadline")
+            except GeneratorExit:
+                self._release(endpoint, time.monotonic() - start)
+                raise
+            except Exception as e:
+                if not admitted:
+                    self._release(endpoint, 0.0)
+                    raise
+                self._release(endpoint, time.monotonic() - start, error=e)
+                # the output can not be switched to another server once it is started
+                if started or isinstance(e, TimeoutError):
+                    raise LLMApiError(e, retryable=is_retryable_error(e))
+                last_error = e
+                continue
+            finally:
+                if stream is not None:
+                    stream.close()
+            self._release(endpoint, time.monotonic() - start, tokens=tokens)
+            return
+        raise LLMApiError(last_error, retryable=is_retryable_error(last_error))
+
+    def admission_stats(self) -> dict:
+        return {endpoint.host: llm_admission.stats(endpoint.host) for endpoint in self.endpoints}
+
+    def get_respond_content(self) -> str:
+        return self.response['message']['content']
+
+    def get_respond_tokens(self) -> int:
+        return trunc(int(self.response['eval_count']))
+
+    def get_prompt_tokens(self) -> int:
+        return int(self.response.get('prompt_eval_count') or 0)
+
+    def stats(self) -> dict:
+        """
+        Throughput and latency of each server
+        """
+        with self._lock:
+            return {
+                endpoint.host: {
+                    "healthy": endpoint.healthy,
+                    "outstanding": endpoint.outstanding,
+                    "requests": endpoint.requests,
+                    "errors": endpoint.errors,
+                    "avg_latency_seconds": round(endpoint.latency_total / endpoint.requests, 2)
+                    if endpoint.requests else 0.0,
+                    "tokens_per_second": round(endpoint.tokens / endpoint.latency_total, 2)
+                    if endpoint.latency_total else 0.0,
+                }
+                for endpoint in self.endpoints
+            }
@@ -0,0 +1,90 @@
+import time
+from typing import Iterable, Iterator
+
+
+THINK_START = "<think>"
+THINK_END = "</think>"
+# Leading characters of a response searched for the end tag of reasoning content without a start tag
+UNTAGGED_THINK_MAX_CHARS = 32 * 1024
+
+
+class StreamStats:
+    """
+    Time to first token and generation speed of a streaming response
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.first_token_at = None
+        self.end = None
+        self.chunks = 0
+
+    def track(self, chunks: Iterable[str]) -> Iterator[str]:
+        for chunk in chunks:
+            if self.first_token_at is None:
+                self.first_token_at = time.monotonic()
+            self.chunks += 1
+            yield chunk
+        self.end = time.monotonic()
+
+    @property
+    def ttft(self) -> float:
+        return (self.first_token_at or time.monotonic()) - self.start
+
+    def tokens_per_second(self, tokens: int) -> float:
+        if self.first_token_at is None:
+            return 0.0
+        elapsed = (self.end or time.monotonic()) - self.first_token_at
+        return tokens / elapsed if elapsed > 0 else 0.0
+
+
+def strip_think(chunks: Iterable[str], max_untagged_chars: int = UNTAGGED_THINK_MAX_CHARS) -> Iterator[str]:
+    """
+    Drop the reasoning content in <think></think> from a streaming response.
+    Only a tail as long as the end tag is kept while the reasoning is streamed.
+    Some models omit the start tag, then everything before the first end tag is dropped,
+    the head of the response is buffered until the end tag or up to max_untagged_chars.
+    """
+    head = ""
+    tail = ""
+    # None until it is known whether the response starts with the reasoning content
+    thinking = None
+    for chunk in chunks:
+        if thinking is None:
+            # the reasoning content must be at the beginning of the response
+            head += chunk
+            stripped = head.lstrip()
+            if len(stripped) < len(THINK_START) and THINK_START.startswith(stripped):
+                continue
+            if stripped.startswith(THINK_START):
+                thinking = True
+                chunk = stripped[len(THINK_START):]
+            else:
+                index = head.find(THINK_END, max(0, len(head) - len(chunk) - len(THINK_END)))
+                if index >= 0:
+                    thinking = False
+                    answer = head[index + len(THINK_END):].lstrip()
+                    if answer:
+                        yield answer
+                elif len(head) > max_untagged_chars:
+                    # no reasoning content in the head, it is the answer
+                    thinking = False
+                    yield head
+                continue
+
+        if not thinking:
+            yield chunk
+            continue
+
+        tail += chunk
+        index = tail.find(THINK_END)
+        if index < 0:
+            tail = tail[-(len(THINK_END) - 1):]
+            continue
+        thinking = False
+        answer = tail[index + len(THINK_END):].lstrip()
+        if answer:
+            yield answer
+
+    if thinking is None and head:
+        yield head
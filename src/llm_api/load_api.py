@@ -1,12 +1,16 @@
 import importlib
+import os
+import threading
 import warnings
+from functools import lru_cache
 
-from config.config import llm_api_impl
+from config.config import api_config, llm_api_impl
 from llm_api.llm_api_interface import LLMApiInterface
 
 
-def get_llm_api_class():
-    module_name, class_name = llm_api_impl.rsplit('.', 1)
+@lru_cache(maxsize=None)
+def get_llm_api_class(impl: str = llm_api_impl):
+    module_name, class_name = impl.rsplit('.', 1)
     module = importlib.import_module(module_name)
     cls = getattr(module, class_name)
     return cls
@@ -18,3 +22,25 @@ def create_llm_api_instance() -> LLMApiInterface:
         warnings.simplefilter("ignore", category=UserWarning)
         cls = get_llm_api_class()
         return cls()
+
+
+_registry: dict[tuple, LLMApiInterface] = {}
+_registry_lock = threading.Lock()
+
+
+def get_llm_api(config: dict | None = None, impl: str = llm_api_impl) -> LLMApiInterface:
+    """
+    获取进程内共享的模型实例，每个配置只创建一次，复用其连接池
+    """
+    config = api_config if config is None else config
+    # the clients must not be shared with the forked gunicorn workers
+    key = (os.getpid(), impl, tuple(sorted((k, str(v)) for k, v in config.items())))
+    with _registry_lock:
+        api = _registry.get(key)
+        if api is None:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=UserWarning)
+                api = get_llm_api_class(impl)()
+            api.set_config(config)
+            _registry[key] = api
+        return api
@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent.parent
+SRC_ROOT = ROOT / 'src'
+
+sys.path.append(SRC_ROOT.as_posix())
+
+
+from llm_api.llm_stream import strip_think
+
+
+def test_strip_think_block():
+    assert "".join(strip_think(["<th", "ink>reason", "ing</thi", "nk>\n", "answer"])) == "answer"
+
+
+def test_strip_think_without_start_tag():
+    assert "".join(strip_think(["reasoning ", "</think>", "answer"])) == "answer"
+    assert "".join(strip_think(["reasoning </th", "ink>\nans", "wer"])) == "answer"
+
+
+def test_strip_think_no_reasoning():
+    assert "".join(strip_think(["just ", "the ", "answer"])) == "just the answer"
+    assert "".join(strip_think(["a" * 10, "b" * 10, "c"], max_untagged_chars=15)) == "a" * 10 + "b" * 10 + "c"
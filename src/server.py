@@ -18,6 +18,7 @@ import os
 
 from flask import Flask, jsonify, make_response
 from app.gitlab_webhook import git
+from app.metrics import metrics
 from utils.args_check import check_config
 from utils.logger import log
 
@@ -30,6 +31,7 @@ app.config['debug'] = debug
 
 # router group
 app.register_blueprint(git, url_prefix='/git')
+app.register_blueprint(metrics)
 
 
 @app.errorhandler(400)
@@ -45,4 +47,6 @@ check_config()
 log.info('Starting the app...')
 
 if __name__ == '__main__':
+    from service.review_queue import review_queue
+    review_queue.start()
     app.run(debug=debug, host="0.0.0.0", port=port, use_reloader=False)
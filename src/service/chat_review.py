@@ -1,101 +1,637 @@
+import contextvars
+import hashlib
+import itertools
 import json
-from retrying import retry
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Iterable, Iterator
 
-from config.config import maximum_files, api_config, gpt_message
-from llm_api.llm_api_interface import LLMApiError
-from llm_api.load_api import create_llm_api_instance
+from config.config import (
+    circuit_failure_threshold,
+    circuit_recovery_seconds,
+    incremental_review,
+    llm_deadline_seconds,
+    llm_max_output_tokens,
+    llm_retry_attempts,
+    llm_retry_base_seconds,
+    llm_retry_cap_seconds,
+    llm_stream,
+    maximum_files,
+    api_config,
+    gpt_message,
+    gpt_reduce_message,
+    llm_output_reserve_tokens,
+    review_cache_db,
+    review_cache_max_entries,
+    review_context_cache_entries,
+    review_context_concurrency,
+    review_context_file_tokens,
+    review_context_tokens,
+    review_discussion_tokens,
+    review_cache_ttl_seconds,
+    review_map_fanout,
+    review_ignore_globs,
+    review_max_file_tokens,
+    review_mode,
+    review_skip_generated,
+    review_triage_tokens,
+    tokenizer_impl
+)
+from llm_api.llm_api_interface import LLMApiError, LLMApiInterface
+from llm_api.llm_stream import StreamStats, strip_think
+from llm_api.load_api import get_llm_api
+from service.content_handle import DiffPreprocessor, PreprocessReport
+from service.context_enrich import ContextEnricher
+from service.discussion import read_discussion, review_marker
 from service.gitlab_api import (
-    add_comment_to_mr, 
-    get_merge_request_changes, 
+    MergeRequestDiffs,
+    compare_commits,
+    create_project_labels,
+    finish_review,
+    get_merge_request_versions,
+    iter_merge_request_notes,
+    get_user_id,
     set_label_done, 
-    set_label_failed,
-    set_approve
+    set_label_wip
+)
+from service.job_store import job_store
+from service.review_cache import ReviewCache, hash_change, hash_keys
+from service.token_budget import TokenBudget, load_tokenizer
+from service.triage import triage
+from utils.logger import Truncated, log
+from utils.metrics import LLM_REQUEST_SECONDS, LLM_TOKENS
+from utils.resilience import CircuitBreaker, RetryPolicy, call_with_retry
+from utils.tracing import record_span, span
+
+
+REVIEW_PROMPT = "以下是一次更改的diff信息，请review这部分代码变更。\n\n"
+CONTEXT_PROMPT = "每个文件的context字段是变更所在的完整函数或代码块，仅供参考，不需要review。\n\n"
+REDUCE_PROMPT = "以下是{count}个部分的review结果，请合并为一份完整的review。\n\n"
+DISCUSSION_PROMPT = "以下是合并请求中评审者的讨论，review时请参考：\n\n{comments}\n\n"
+# Tokens of the header and the separator of each review to merge
+REDUCE_SECTION_TOKENS = 16
+
+# a cached review is only valid for the same model and prompts
+PROMPT_VERSION = hashlib.sha256(
+    "".join([gpt_message, gpt_reduce_message, REVIEW_PROMPT, CONTEXT_PROMPT, REDUCE_PROMPT, DISCUSSION_PROMPT])
+    .encode("utf-8")
+).hexdigest()[:12]
+CACHE_NAMESPACE = f"{api_config['MODEL_NAME']}:{PROMPT_VERSION}"
+
+tokenizer = load_tokenizer(tokenizer_impl)
+review_cache = ReviewCache(review_cache_db, review_cache_ttl_seconds, review_cache_max_entries)
+preprocessor = DiffPreprocessor(review_ignore_globs, review_max_file_tokens, review_skip_generated, tokenizer.count)
+context_enricher = ContextEnricher(review_context_tokens, review_context_file_tokens, review_context_concurrency,
+                                   review_context_cache_entries, tokenizer.count)
+llm_breaker = CircuitBreaker("llm", circuit_failure_threshold, circuit_recovery_seconds)
+llm_retry_policy = RetryPolicy(llm_retry_attempts, llm_retry_base_seconds, llm_retry_cap_seconds)
+
+# Chunks of a streaming response between the checks whether the review is cancelled
+CANCEL_CHECK_CHUNKS = 32
+
+# whether the review in the context is cancelled, the streaming generations stop early if it is
+_is_cancelled: contextvars.ContextVar[Callable[[], bool] | None] = contextvars.ContextVar(
+    "review_is_cancelled", default=None
 )
-from utils.logger import log
 
-def wait_and_retry(exception):
-    return isinstance(exception, LLMApiError)
 
+class ReviewCancelled(Exception):
+    """The review is superseded by a newer commit, or the merge request is closed"""
+    pass
 
-@retry(retry_on_exception=wait_and_retry, stop_max_attempt_number=3, wait_fixed=60000)
-def generate_review_note(change: list[dict]) -> str:
+
+class ReviewFailed(Exception):
+    """The LLM fails to generate the review, the job fails and the merge request is labeled failed"""
+    pass
+
+
+def is_retryable_llm_error(exception: Exception) -> bool:
+    return isinstance(exception, LLMApiError) and exception.retryable
+
+
+def create_token_budget(system_prompt: str, user_prompt: str) -> TokenBudget:
+    return TokenBudget(tokenizer, int(api_config["NUM_CTX"]), llm_output_reserve_tokens, [system_prompt, user_prompt])
+
+
+def generate_llm_note(messages: list[dict]) -> str:
+    """
+    Send the messages to LLM and return the answer without the reasoning content,
+    the transient errors are retried within the retry budget of the review
+    """
+    log.debug("Send to LLM: %s", Truncated(messages))
+    return call_with_retry(partial(request_llm_note, messages), llm_breaker, llm_retry_policy, is_retryable_llm_error)
+
+
+def request_llm_note(messages: list[dict]) -> str:
+    api = get_llm_api()
+    start = time.monotonic()
+    with span("llm", stream=llm_stream) as current:
+        try:
+            review_note = stream_llm_note(api, messages) if llm_stream else generate_note(api, messages)
+        except ReviewCancelled:
+            LLM_REQUEST_SECONDS.labels("cancelled").observe(time.monotonic() - start)
+            raise
+        except Exception:
+            LLM_REQUEST_SECONDS.labels("error").observe(time.monotonic() - start)
+            raise
+        LLM_REQUEST_SECONDS.labels("ok").observe(time.monotonic() - start)
+        try:
+            prompt_tokens, completion_tokens = api.get_prompt_tokens(), api.get_respond_tokens()
+        except Exception as e:
+            log.debug("No token counts in the LLM response: %s", e)
+            return review_note
+        LLM_TOKENS.labels("prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels("completion").inc(completion_tokens)
+        if current is not None:
+            current.attributes.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    return review_note
+
+
+def generate_note(api: LLMApiInterface, messages: list[dict]) -> str:
+    api.generate_text(messages)
+    response_content = api.get_respond_content().replace('\n\n', '\n')
+    total_tokens = api.get_respond_tokens()
+    review_note = response_content
+    if "</think>" in response_content:
+        review_note = response_content.split("</think>")[1].strip()
+    log.info("review result(%s): %s", total_tokens, Truncated(response_content))
+    return review_note
+
+
+def check_stream_cancelled(stream: Iterator[str], chunks: Iterable[str]) -> Iterator[str]:
+    """
+    Stop the stream if the review in the context is cancelled, it is checked every CANCEL_CHECK_CHUNKS chunks
+    :param stream: the generation, it is closed to stop the generation and release its slot
+    :param chunks: chunks of the stream
+    """
+    is_cancelled = _is_cancelled.get()
+    if is_cancelled is None:
+        yield from chunks
+        return
+    for i, chunk in enumerate(chunks, start=1):
+        if i % CANCEL_CHECK_CHUNKS == 0 and is_cancelled():
+            stream.close()
+            raise ReviewCancelled(f"Review is cancelled while the LLM generates, stop after {i} chunks")
+        yield chunk
+
+
+def stream_llm_note(api: LLMApiInterface, messages: list[dict]) -> str:
+    """
+    Stream the answer from LLM, the reasoning content is dropped without buffering it.
+    The generation stops with ReviewCancelled if the review is cancelled meanwhile.
+    """
+    stats = StreamStats()
+    deadline = time.monotonic() + llm_deadline_seconds
+    stream = api.stream_text(messages, max_tokens=llm_max_output_tokens, deadline=deadline)
+    chunks = check_stream_cancelled(stream, stats.track(stream))
+    answer_at = None
+    answer = []
+    for chunk in strip_think(chunks):
+        if answer_at is None:
+            answer_at = time.monotonic()
+        answer.append(chunk)
+    answer = "".join(answer)
+    # the first token comes after the prompt is evaluated, the answer comes after the reasoning content
+    if stats.first_token_at is not None:
+        end = stats.end or time.monotonic()
+        record_span("llm.prompt", stats.start, stats.first_token_at)
+        record_span("llm.reasoning", stats.first_token_at, answer_at or end)
+        record_span("llm.answer", answer_at or end, end)
+    try:
+        total_tokens = api.get_respond_tokens()
+    except Exception:
+        total_tokens = stats.chunks
+    log.info("LLM stream: ttft %.1fs, %s tokens, %.1f tokens/s",
+             stats.ttft, total_tokens, stats.tokens_per_second(total_tokens))
+
+    review_note = answer.replace('\n\n', '\n').strip()
+    log.info("review result(%s): %s", total_tokens, Truncated(review_note))
+    return review_note
+
+
+def review_prompt(discussion: str, with_context: bool) -> str:
+    return f"{discussion}{REVIEW_PROMPT}{CONTEXT_PROMPT if with_context else ''}"
+
+
+def generate_review_note(change: list[dict], discussion: str = "") -> str:
     try:
         content = json.dumps(change, ensure_ascii=False)
+        prompt = review_prompt(discussion, any("context" in item for item in change))
         
         messages = [
             {"role": "system",
              "content": gpt_message
              },
             {"role": "user",
-             "content": f"以下是一次更改的diff信息，请review这部分代码变更。\n\n{content}",
+             "content": f"{prompt}{content}",
              },
         ]
-        log.debug(f"Send to LLM: {messages}")
-        api = create_llm_api_instance()
-        api.set_config(api_config)
-        api.generate_text(messages)
-        response_content = api.get_respond_content().replace('\n\n', '\n')
-        total_tokens = api.get_respond_tokens()
-        review_note = response_content
-        if "</think>" in response_content:
-            review_note = response_content.split("</think>")[1].strip()
-        log.info(f"review result({total_tokens}): {response_content}")
-        return review_note
+        return generate_llm_note(messages)
+    except ReviewCancelled:
+        raise
+    except Exception as e:
+        log.error(f"GPT error:{e}")
+        return ""
+
+
+def generate_reduce_note(partial_notes: list[str]) -> str:
+    """
+    Merge the reviews of the chunks into one review.
+    Reviews which do not fit one prompt are merged in batches,
+    and the merged reviews are merged again until one is left.
+    """
+    try:
+        budget = create_token_budget(gpt_reduce_message, REDUCE_PROMPT)
+        notes, level = partial_notes, 0
+        while True:
+            level += 1
+            batches = budget.batch_texts(notes, REDUCE_SECTION_TOKENS)
+            log.info(f"Reduce {len(notes)} reviews in {len(batches)} batches, level {level}, "
+                     f"available {budget.available} tokens")
+            merged = [reduce_batch(batch) if len(batch) > 1 else batch[0] for batch in batches]
+            if not all(merged):
+                return ""
+            if len(merged) == 1:
+                return merged[0]
+            notes = merged
+    except ReviewCancelled:
+        raise
     except Exception as e:
         log.error(f"GPT error:{e}")
         return ""
 
 
+def reduce_batch(notes: list[str]) -> str:
+    """
+    Merge the reviews of a batch, they fit the token budget of one prompt
+    """
+    content = "\n\n".join(
+        f"# 第{i}部分\n\n{note}" for i, note in enumerate(notes, start=1)
+    )
+    messages = [
+        {"role": "system",
+         "content": gpt_reduce_message
+         },
+        {"role": "user",
+         "content": f"{REDUCE_PROMPT.format(count=len(notes))}{content}",
+         },
+    ]
+    return generate_llm_note(messages)
+
+
+def cache_namespace(discussion: str) -> str:
+    """
+    Namespace of the cached review of a whole merge request, it is only valid with the comments of the reviewers.
+    The reviews of the files do not depend on the comments, so a new comment does not invalidate them.
+    """
+    if not discussion:
+        return CACHE_NAMESPACE
+    return f"{CACHE_NAMESPACE}:{hashlib.sha256(discussion.encode('utf-8')).hexdigest()[:12]}"
+
+
+def change_cache_key(change: dict, namespace: str = CACHE_NAMESPACE) -> str:
+    return hash_change(change, namespace)
+
+
+def chunk_cache_key(file_keys: list[str]) -> str:
+    """
+    Cache key of the review of a chunk with several files, it is only valid if none of the files changes
+    """
+    return hash_keys(file_keys, "chunk")
+
+
+def chunk_ref_cache_key(file_key: str) -> str:
+    """
+    Cache key of the file keys of the chunk the file is reviewed in
+    """
+    return hash_keys([file_key], "chunk-ref")
+
+
+def map_reduce_review(changes: Iterable[dict], discussion: str = "",
+                      enrich: Callable[[Iterable[dict]], Iterator[dict]] = iter) -> str:
+    """
+    Review the chunks of the changes in parallel, then merge the reviews of the chunks.
+    A chunk is reviewed as soon as it is packed, before the rest of the changes are fetched.
+    The files whose diff is reviewed before reuse the cached reviews: the review of a file reviewed alone,
+    or the review of a chunk of several files if none of them changed.
+    :param discussion: comments of the reviewers sent with each chunk
+    :param enrich: add the context to the changes, only the changes without a cached review are enriched
+    """
+    namespace = cache_namespace(discussion)
+    keys, partial_notes, chunk_keys, futures = [], [], [], []
+    file_keys: dict[tuple, str] = {}
+    # changes reviewed before in a chunk with other files, and the file keys of that chunk
+    grouped: list[tuple[dict, list[str]]] = []
+
+    def reuse(note: str):
+        if note not in partial_notes:
+            partial_notes.append(note)
+
+    def uncached_changes() -> Iterator[dict]:
+        for change in changes:
+            key = change_cache_key(change)
+            keys.append(key)
+            file_keys[(change.get("old_path"), change.get("new_path"))] = key
+            note = review_cache.get(key)
+            if note is not None:
+                reuse(note)
+                continue
+            members = review_cache.get(chunk_ref_cache_key(key))
+            if members is not None:
+                grouped.append((change, members.split()))
+                continue
+            yield change
+        # the review of a chunk is only reused if all of its files are unchanged, which is known at the end
+        unchanged = set(keys)
+        for change, members in grouped:
+            note = review_cache.get(chunk_cache_key(members)) if unchanged.issuperset(members) else None
+            if note is None:
+                yield change
+            else:
+                reuse(note)
+
+    executor = ThreadPoolExecutor(max_workers=review_map_fanout, thread_name_prefix="review-map")
+    try:
+        budget = create_token_budget(gpt_message, review_prompt(discussion, review_context_tokens > 0))
+        for chunk in budget.pack_stream(enrich(uncached_changes()), max_open=review_map_fanout):
+            # a file split into several chunks has the key of the whole file
+            chunk_keys.append([file_keys[(change.get("old_path"), change.get("new_path"))] for change in chunk])
+            # the chunks share the retry budget of the review
+            futures.append(executor.submit(contextvars.copy_context().run, generate_review_note, chunk, discussion))
+        notes = [future.result() for future in futures]
+    finally:
+        # the chunks not started yet are dropped if fetching the changes fails
+        executor.shutdown(wait=True, cancel_futures=True)
+    reviewed = len({key for key_list in chunk_keys for key in key_list})
+    log.info(f"Review cache: reuse {len(keys) - reviewed} files, review {reviewed} files "
+             f"in {len(chunk_keys)} chunks with fan-out {review_map_fanout}")
+
+    mr_key = hash_keys(keys, namespace)
+    if not futures:
+        review_note = review_cache.get(mr_key)
+        if review_note is not None:
+            log.info("Review cache: reuse the review of the whole merge request")
+            return review_note
+
+    failed = sum(1 for note in notes if not note)
+    if failed:
+        # the merged review must not miss any chunk
+        log.error(f"Review {failed} of {len(futures)} chunks failed")
+        return ""
+
+    # a file split into several chunks is covered by all of their reviews, it is cached alone
+    # if none of the chunks has another file, as the review of a chunk has the findings of all its files
+    chunks_of: dict[str, list[int]] = {}
+    for i, key_list in enumerate(chunk_keys):
+        for key in dict.fromkeys(key_list):
+            chunks_of.setdefault(key, []).append(i)
+    for key, indexes in chunks_of.items():
+        if all(len(set(chunk_keys[i])) == 1 for i in indexes):
+            review_cache.put(key, "\n\n".join(dict.fromkeys(notes[i] for i in indexes)))
+    for key_list, note in zip(chunk_keys, notes):
+        members = sorted(set(key_list))
+        if len(members) > 1 and all(len(chunks_of[key]) == 1 for key in members):
+            review_cache.put(chunk_cache_key(members), note)
+            for key in members:
+                review_cache.put(chunk_ref_cache_key(key), " ".join(members))
+    partial_notes.extend(note for note in notes if note not in partial_notes)
+
+    if not partial_notes:
+        return ""
+    review_note = partial_notes[0] if len(partial_notes) == 1 else generate_reduce_note(partial_notes)
+    if review_note:
+        review_cache.put(mr_key, review_note)
+    return review_note
+
+
 def chat_review(commit_index, project_id, commit_id, changes, context_info, merge_comment_details):
+    """
+    :param project_id: project of the merge request
+    :param commit_id: head commit of the changes, the context of the changes is read at it
+    :param merge_comment_details: comments of the reviewers, formatted by discussion_prompt
+    """
     log.info("Start to review the code changes")
-    result = generate_review_note(changes)
-    return result
+    enrich = iter
+    if project_id and commit_id:
+        enrich = partial(context_enricher.iter_enrich, project_id=project_id, ref=commit_id)
+    if review_mode != "single":
+        return map_reduce_review(changes, merge_comment_details, enrich)
+
+    changes = list(changes)
+    namespace = cache_namespace(merge_comment_details)
+    mr_key = hash_keys([change_cache_key(change) for change in changes], namespace)
+    review_note = review_cache.get(mr_key)
+    if review_note is not None:
+        log.info("Review cache: reuse the review of the whole merge request")
+        return review_note
+
+    changes = list(enrich(changes))
+    budget = create_token_budget(gpt_message, review_prompt(merge_comment_details, review_context_tokens > 0))
+    tokens = budget.count_changes(changes)
+    log.info(f"Token budget: {len(changes)} files, {tokens} tokens, available {budget.available}")
+    if tokens > budget.available:
+        log.warning(f"Prompt exceeds the token budget by {tokens - budget.available} tokens, "
+                    f"it may be truncated by the model")
+    review_note = generate_review_note(changes, merge_comment_details)
+    if review_note:
+        review_cache.put(mr_key, review_note)
+    return review_note
+
+
+def discussion_prompt(comments: list[str]) -> str:
+    if not comments:
+        return ""
+    return DISCUSSION_PROMPT.format(comments="\n\n".join(comments))
+
+
+def same_base(versions: list[dict], reviewed_sha: str) -> bool:
+    """
+    Whether the reviewed head commit and the latest one have the same base commit in the target branch
+    :param versions: diff versions of the merge request, the latest version is the first
+    """
+    reviewed = next((version for version in versions if version["head_commit_sha"] == reviewed_sha), None)
+    return reviewed is not None and reviewed["base_commit_sha"] == versions[0]["base_commit_sha"]
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
-def review_code_for_mr(project_id: int, merge_id: int, gitlab_message: dict):
+def prepare_review(project_id: int, merge_id: int, gitlab_message: dict) -> bool:
+    """
+    GitLab requests before the review, they are done by the review worker so the webhook returns at once
+    :return: False if the bot is not a reviewer of the merge request
+    """
+    reviewer_ids = gitlab_message['object_attributes'].get('reviewer_ids') or []
+    if get_user_id() not in reviewer_ids:
+        return False
+    create_project_labels(project_id)
+    set_label_wip(project_id, merge_id)
+    return True
+
+
+def estimate_review_cost(project_id: int, merge_id: int) -> int:
+    """
+    Estimate the cost of a review by the tokens of the merge request diff to review
+    """
+    report = PreprocessReport()
+    for _ in preprocessor.iter_process(MergeRequestDiffs(project_id, merge_id), report):
+        pass
+    if report.kept > maximum_files:
+        # only the riskiest files are reviewed
+        return min(report.tokens_after, review_triage_tokens)
+    return report.tokens_after
+
+
+def record_report(report: PreprocessReport):
+    # the files are preprocessed one by one while they are fetched and reviewed, the span is the total time
+    end = time.monotonic()
+    record_span("preprocess", end - report.seconds, end, files=report.files, kept=report.kept,
+                tokens_saved=report.tokens_saved)
+
+
+def review_code_for_mr(project_id: int, merge_id: int, gitlab_message: dict,
+                       is_cancelled: Callable[[], bool] = lambda: False):
     """
     code review for gitlab merge request
+    :param is_cancelled: checked between the stages and while the LLM streams,
+        the review stops with ReviewCancelled if it returns True
+    :raises ReviewFailed: the LLM fails to generate the review, the caller labels the merge request failed
     """
-    project_name = gitlab_message['project']['name']
-    # Get the changes of the merge request
-    changes = get_merge_request_changes(project_id, merge_id)
+    # the map-reduce chunks see it in the copies of the context
+    token = _is_cancelled.set(is_cancelled)
+    try:
+        _review_code_for_mr(project_id, merge_id, gitlab_message, is_cancelled)
+    finally:
+        _is_cancelled.reset(token)
 
-    if not changes:
-        log.error(
-            f"Project name: {project_name}\n"
-            f"Get merge_request changes failed ❌, project_id: {project_id} | merge_id: {merge_id} | mr: {gitlab_message}")
-        raise Exception(f"Get merge_request changes failed, project_id: {project_id} | merge_id: {merge_id}")
-    
+
+def _review_code_for_mr(project_id: int, merge_id: int, gitlab_message: dict, is_cancelled: Callable[[], bool]):
+    def check_cancelled(stage: str):
+        if is_cancelled():
+            raise ReviewCancelled(f"Review of mr {project_id}!{merge_id} is cancelled {stage}")
+
+    project_name = gitlab_message['project']['name']
     mr_url = gitlab_message['object_attributes']['url']
     branch_from = gitlab_message['object_attributes']['source_branch']
     branch_to = gitlab_message['object_attributes']['target_branch']
 
-    if len(changes) > maximum_files:
-        log.error(
-            f"Project name: {project_name}\n"
-            f"Modify {len(changes)} > {maximum_files} files, do not codereview ⚠️ \n"
-            f"Mr url: {mr_url}\n"
-            f"From: {branch_from} to: {branch_to}")
+    check_cancelled("before fetching changes")
+
+    # Review only the commits pushed since the last review if the event is a push
+    with span("fetch_changes"):
+        versions = get_merge_request_versions(project_id, merge_id)
+    if versions:
+        head_sha = versions[0]["head_commit_sha"]
+    else:
+        # GitLab creates the diff of a new merge request asynchronously, the event has the head commit
+        head_sha = (gitlab_message['object_attributes'].get('last_commit') or {}).get('id')
+        if not head_sha:
+            raise Exception(f"No diff version nor last commit of mr {project_id}!{merge_id}")
+        log.info(f"No diff version of mr {project_id}!{merge_id} yet, head commit of the event: {head_sha}")
+    pushed = incremental_review and bool(gitlab_message['object_attributes'].get('oldrev'))
+    discussion = None
+    if pushed or review_discussion_tokens > 0:
+        # the notes are read from the newest, for the latest review of the bot and the comments of the reviewers
+        try:
+            with span("discussion"):
+                discussion = read_discussion(iter_merge_request_notes(project_id, merge_id), get_user_id(),
+                                             review_discussion_tokens, tokenizer.count, find_review=pushed)
+        except Exception as e:
+            log.warning(f"Fails to read the discussion of mr {project_id}!{merge_id}, review without it: {e}")
+    reviewed_sha = None
+    if pushed:
+        # the review marker is the fallback if the job store does not know the merge request, e.g. it is reset
+        reviewed_sha = job_store.get_reviewed_head(project_id, merge_id) or (discussion and discussion.reviewed_sha)
+    changes = None
+    if reviewed_sha == head_sha:
+        log.info(f"Mr url: {mr_url}\nNo new commits since the last review ({head_sha})")
+        set_label_done(project_id, merge_id)
+        return
+    if reviewed_sha and not same_base(versions, reviewed_sha):
+        # after a rebase onto the updated target branch, the new commits are mixed with the upstream commits
+        log.info(f"Mr url: {mr_url}\nThe base moved since the last review ({reviewed_sha}), review all the changes")
+        reviewed_sha = None
+    if reviewed_sha:
+        with span("fetch_changes", incremental=True):
+            changes = compare_commits(project_id, reviewed_sha, head_sha)
+        if changes is None:
+            reviewed_sha = None
+        elif not changes:
+            log.info(f"Mr url: {mr_url}\nNo changes between {reviewed_sha} and {head_sha}")
+            job_store.set_reviewed_head(project_id, merge_id, head_sha)
+            set_label_done(project_id, merge_id)
+            return
+        else:
+            log.info(f"Mr url: {mr_url}\nIncremental review {reviewed_sha}...{head_sha}, {len(changes)} files")
+
+    # Get the changes of the merge request, the pages are fetched while the changes are reviewed
+    total = len(changes) if changes is not None else None
+    if changes is None:
+        with span("fetch_changes"):
+            changes = MergeRequestDiffs(project_id, merge_id)
+        total = changes.total
+        if total == 0:
+            log.error(
+                f"Project name: {project_name}\n"
+                f"Get merge_request changes failed ❌, project_id: {project_id} | merge_id: {merge_id} | "
+                f"mr: {Truncated(gitlab_message)}")
+            raise Exception(f"Get merge_request changes failed, project_id: {project_id} | merge_id: {merge_id}")
+
+    # Drop the lockfiles, generated code, whitespace-only hunks, etc.
+    report = PreprocessReport()
+    changes = preprocessor.iter_process(changes, report)
+
+    # Review only the riskiest files of an oversized mr, all the files are fetched to rank them
+    triaged = None
+    if total is None or total > maximum_files:
+        changes = list(changes)
+        if len(changes) > maximum_files:
+            with span("triage", files=len(changes)):
+                triaged = triage(changes, maximum_files, review_triage_tokens, tokenizer.count)
+            log.warning(
+                f"Project name: {project_name}\n"
+                f"Modify {len(changes)} > {maximum_files} files, review {len(triaged.covered)} riskiest files ⚠️ \n"
+                f"Mr url: {mr_url}\n"
+                f"From: {branch_from} to: {branch_to}")
+            changes = triaged.covered
+
+    changes = iter(changes)
+    first = next(changes, None)
+    if first is None:
+        preprocessor.record(report)
+        record_report(report)
+        log.info(f"Mr url: {mr_url}\nNothing to review after preprocessing the diff")
+        job_store.set_reviewed_head(project_id, merge_id, head_sha)
+        set_label_done(project_id, merge_id)
         return
 
     # Get CR from LLM
-    review_info = chat_review("", project_id, "", changes, "", "")
+    check_cancelled("before the LLM review")
+    comments = discussion_prompt(discussion.comments if discussion else [])
+    with span("review"):
+        review_info = chat_review("", project_id, head_sha, itertools.chain([first], changes), "", comments)
+    preprocessor.record(report)
+    record_report(report)
+    reviewed_files = len(triaged.covered) if triaged else report.kept
+    check_cancelled("after the LLM review")
     if review_info != "":
-        add_comment_to_mr(project_id, merge_id, review_info)
-        set_label_done(project_id, merge_id)
-        set_approve(project_id, merge_id)
+        if triaged:
+            review_info = f"{review_info}\n\n{triaged.note()}"
+        if reviewed_sha:
+            review_info = f"> 🔄 增量审核: {reviewed_sha[:8]}...{head_sha[:8]}\n\n{review_info}"
+        review_info = f"{review_info}\n\n{review_marker(head_sha)}"
+        with span("post_review"):
+            finish_review(project_id, merge_id, review_info)
+        job_store.set_reviewed_head(project_id, merge_id, head_sha)
         log.info(
             f"Project name: {project_name}\n"
             f"Mr url: {mr_url}\n"
             f"from: {branch_from} to: {branch_to} \n"
-            f"Modify files: {len(changes)}\n"
+            f"Modify files: {reviewed_files}\n"
             f"CR status: Success generate ✅")
     else:
-        set_label_failed(project_id, merge_id)
         log.error(
             f"Project name: {project_name}\n"
             f"Mr url: {mr_url}\n"
             f"from: {branch_from} to: {branch_to} \n"
-            f"Modify files: {len(changes)} \n"
+            f"Modify files: {reviewed_files} \n"
             f"CR status: Failed generate ❌")
+        raise ReviewFailed(f"LLM fails to generate the review of mr {project_id}!{merge_id}")
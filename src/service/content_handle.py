@@ -1,5 +1,233 @@
+import fnmatch
 import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator
+
+from utils.logger import Truncated, log
+
+
 def filter_diff_content(diff_content):
     filtered_content = re.sub(r'(^-.*\n)|(^@@.*\n)', '', diff_content, flags=re.MULTILINE)
     processed_code = '\n'.join([line[1:] if line.startswith('+') else line for line in filtered_content.split('\n')])
     return processed_code
+
+
+# Reasons to skip a file
+SKIP_IGNORED = "ignored"
+SKIP_GENERATED = "generated"
+SKIP_BINARY = "binary"
+SKIP_RENAME_ONLY = "rename_only"
+SKIP_WHITESPACE_ONLY = "whitespace_only"
+SKIP_EMPTY = "empty"
+SKIP_TOO_LARGE = "too_large"
+
+# Marker appended to a diff which is cut to the size cap of a file
+CAPPED_MARKER = "\n... (the rest of the diff is omitted)\n"
+
+# Markers of generated code in the first lines of a file
+_GENERATED_PATTERN = re.compile(
+    r"@generated|code generated .* do not edit|auto-?generated|generated by .*(protoc|thrift|swagger|openapi)",
+    re.IGNORECASE
+)
+_BINARY_PATTERN = re.compile(r"^Binary files .* differ$", re.MULTILINE)
+_HUNK_PATTERN = re.compile(r"(?m)^(?=@@)")
+# A hunk at the top of the new file shows its header
+_HEAD_HUNK_PATTERN = re.compile(r"^@@ -\d+(?:,\d+)? \+1(?:,\d+)? @@.*\n((?:.*\n?){0,10})")
+# Indentation changes the meaning of these files
+INDENT_SENSITIVE_SUFFIXES = (".py", ".yaml", ".yml", ".mk", "Makefile", ".haml", ".pug", ".coffee")
+# Minified code has very long lines
+MINIFIED_LINE_LENGTH = 1000
+
+
+def compile_globs(globs: list[str]) -> re.Pattern:
+    """
+    Compile the path globs into one pattern.
+    A glob without a slash matches the file name, e.g. *.lock,
+    a glob with a slash matches the path in any directory, e.g. vendor/* matches a/vendor/b.go
+    """
+    patterns = []
+    for glob in globs:
+        regex = fnmatch.translate(glob.strip().lstrip("/"))
+        patterns.append(f"(?:.*/)?{regex}")
+    return re.compile("|".join(patterns) if patterns else r"(?!)")
+
+
+def _diff_lines(diff: str) -> tuple[list[str], list[str]]:
+    added, removed = [], []
+    for line in diff.splitlines():
+        if line.startswith("+"):
+            added.append(line[1:])
+        elif line.startswith("-"):
+            removed.append(line[1:])
+    return added, removed
+
+
+def is_whitespace_only(hunk: str, keep_indent: bool = False) -> bool:
+    """
+    Whether the hunk only changes the whitespace around the lines, e.g. the indentation or the blank lines.
+    The whitespace inside a line is kept, it may be in a string literal.
+    :param keep_indent: only the trailing whitespace is insignificant, e.g. in python
+    """
+    added, removed = _diff_lines(hunk)
+    if not added and not removed:
+        return False
+    if keep_indent:
+        return [line.rstrip() for line in added] == [line.rstrip() for line in removed]
+    return [line.strip() for line in added if line.strip()] == [line.strip() for line in removed if line.strip()]
+
+
+def is_generated(change: dict) -> bool:
+    """
+    Guess whether the file is generated by its header or its line length
+    """
+    if change.get("generated_file"):
+        # set by GitLab 16.9+
+        return True
+    diff = change.get("diff") or ""
+    head = _HEAD_HUNK_PATTERN.match(diff)
+    if head is not None and _GENERATED_PATTERN.search(head.group(1)):
+        return True
+    added, _ = _diff_lines(diff)
+    return any(len(line) > MINIFIED_LINE_LENGTH for line in added)
+
+
+@dataclass
+class PreprocessReport:
+    files: int = 0
+    skipped: dict[str, list[str]] = field(default_factory=dict)
+    whitespace_hunks: int = 0
+    capped: list[str] = field(default_factory=list)
+    tokens_before: int = 0
+    tokens_after: int = 0
+    # time spent in preprocessing
+    seconds: float = 0.0
+
+    @property
+    def kept(self) -> int:
+        return self.files - sum(len(paths) for paths in self.skipped.values())
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+    def __str__(self) -> str:
+        ratio = self.tokens_saved / self.tokens_before if self.tokens_before else 0.0
+        skipped = ", ".join(f"{reason} {len(paths)}" for reason, paths in self.skipped.items()) or "none"
+        return (f"{self.files} -> {self.kept} files, {self.tokens_before} -> {self.tokens_after} tokens "
+                f"(saved {self.tokens_saved}, {ratio:.0%}) | skipped: {skipped}, "
+                f"whitespace hunks {self.whitespace_hunks}, capped {len(self.capped)} files")
+
+
+class DiffPreprocessor:
+    """
+    Drop the changes which are not worth a review before they are sent to the LLM:
+    ignored paths, generated and binary files, renames without changes, whitespace-only hunks,
+    and cut the diff of a file to the size cap.
+    """
+
+    def __init__(self, ignore_globs: list[str], max_file_tokens: int, skip_generated: bool,
+                 count: Callable[[str], int]):
+        """
+        :param ignore_globs: paths to skip, e.g. *.lock, vendor/*
+        :param max_file_tokens: size cap of the diff of a file, 0 means unlimited
+        :param skip_generated: skip the files which look generated
+        :param count: count the tokens of a text
+        """
+        self.ignore = compile_globs(ignore_globs)
+        self.max_file_tokens = max_file_tokens
+        self.skip_generated = skip_generated
+        self.count = count
+        self._lock = threading.Lock()
+        self._merge_requests = 0
+        self._tokens_before = 0
+        self._tokens_after = 0
+
+    def skip_reason(self, change: dict) -> str | None:
+        path = change.get("new_path") or change.get("old_path") or ""
+        diff = change.get("diff") or ""
+        if self.ignore.fullmatch(path):
+            return SKIP_IGNORED
+        if change.get("too_large") or (change.get("collapsed") and not diff.strip()):
+            # GitLab does not return the diff of the file
+            return SKIP_TOO_LARGE
+        if _BINARY_PATTERN.search(diff):
+            return SKIP_BINARY
+        if not diff.strip():
+            return SKIP_RENAME_ONLY if change.get("renamed_file") else SKIP_EMPTY
+        if self.skip_generated and is_generated(change):
+            return SKIP_GENERATED
+        return None
+
+    def cap(self, diff: str) -> str:
+        """
+        Keep the leading hunks of the diff within the size cap
+        """
+        if not self.max_file_tokens or self.count(diff) <= self.max_file_tokens:
+            return diff
+        kept, tokens = "", 0
+        for hunk in _HUNK_PATTERN.split(diff):
+            hunk_tokens = self.count(hunk)
+            if tokens + hunk_tokens > self.max_file_tokens:
+                if not kept:
+                    # the first hunk is larger than the cap, keep its head, the ratio is estimated by the characters
+                    kept = hunk[:len(hunk) * self.max_file_tokens // hunk_tokens]
+                break
+            kept += hunk
+            tokens += hunk_tokens
+        return kept + CAPPED_MARKER
+
+    def iter_process(self, changes: Iterable[dict], report: PreprocessReport) -> Iterator[dict]:
+        """
+        Reduce the changes one by one while they are fetched, the report is complete when the iteration ends
+        :return: the changes to review, with the diffs reduced
+        """
+        for change in changes:
+            start = time.monotonic()
+            path = change.get("new_path") or change.get("old_path") or ""
+            diff = change.get("diff") or ""
+            report.files += 1
+            report.tokens_before += self.count(diff)
+
+            reason = self.skip_reason(change)
+            if reason is None:
+                hunks = _HUNK_PATTERN.split(diff)
+                keep_indent = path.endswith(INDENT_SENSITIVE_SUFFIXES)
+                kept = [hunk for hunk in hunks if not is_whitespace_only(hunk, keep_indent)]
+                report.whitespace_hunks += len(hunks) - len(kept)
+                diff = "".join(kept)
+                if not diff.strip():
+                    reason = SKIP_WHITESPACE_ONLY
+            if reason is not None:
+                report.skipped.setdefault(reason, []).append(path)
+                report.seconds += time.monotonic() - start
+                continue
+
+            capped = self.cap(diff)
+            if capped is not diff:
+                report.capped.append(path)
+            report.tokens_after += self.count(capped)
+            report.seconds += time.monotonic() - start
+            yield {**change, "diff": capped}
+
+    def record(self, report: PreprocessReport):
+        """
+        Log the report of a merge request and add it to the statistics
+        """
+        with self._lock:
+            self._merge_requests += 1
+            self._tokens_before += report.tokens_before
+            self._tokens_after += report.tokens_after
+        log.info(f"Preprocess diff: {report}")
+        if report.skipped:
+            log.debug("Preprocess diff skipped files: %s", Truncated(report.skipped))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "merge_requests": self._merge_requests,
+                "tokens_before": self._tokens_before,
+                "tokens_after": self._tokens_after,
+                "saved_ratio": round(1 - self._tokens_after / self._tokens_before, 3) if self._tokens_before else 0.0,
+            }
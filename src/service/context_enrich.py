@@ -0,0 +1,256 @@
+import contextvars
+import re
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+from service.get_url_raw import get_blob_content, get_file_blob
+from utils.logger import log
+
+
+# New line range of a hunk
+_HUNK_RANGE_PATTERN = re.compile(r"(?m)^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@")
+# Line that starts a function, a class or a similar block in the common languages
+_DEFINITION_PATTERN = re.compile(
+    r"^\s*(?:(?:export|default|public|private|protected|internal|static|async|abstract|final|override|"
+    r"pub(?:\([^)]*\))?|unsafe|extern)\s+)*"
+    r"(?:def|class|func|function|fn|interface|struct|enum|impl|trait|module|namespace|object)\b"
+    # a c-like function or method signature, e.g. public void run() {
+    r"|^\s*(?!(?:return|else|new|throw|await|case|if|for|while|switch|catch)\b)"
+    r"(?:[\w\[\]<>?,.*&:]+\s+)+\*?\w+\s*\([^;]*$"
+)
+# Line that closes a block, it belongs to the region
+_BLOCK_END_PATTERN = re.compile(r"^\s*(?:[}\])]|end\b)")
+
+# Lines around a hunk which is not in a definition
+WINDOW_LINES = 10
+# Lines of an enclosing region, a larger one falls back to the window
+MAX_REGION_LINES = 200
+# Larger files are not fetched
+MAX_FILE_BYTES = 512 * 1024
+
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip())
+
+
+def hunk_ranges(diff: str) -> list[tuple[int, int]]:
+    """
+    Line ranges of the hunks in the new file, 1-based and inclusive
+    """
+    ranges = []
+    for match in _HUNK_RANGE_PATTERN.finditer(diff):
+        start = int(match.group(1))
+        count = int(match.group(2)) if match.group(2) is not None else 1
+        if count > 0:
+            ranges.append((start, start + count - 1))
+    return ranges
+
+
+def enclosing_region(lines: list[str], start: int, end: int) -> tuple[int, int]:
+    """
+    Line range of the function or block which encloses the lines, or a window around them
+    :param lines: lines of the new file
+    :param start: first line, 1-based
+    :param end: last line, 1-based
+    """
+    first = None
+    if start <= len(lines) and _DEFINITION_PATTERN.match(lines[start - 1]):
+        # the hunk starts with a definition
+        first = start - 1
+    else:
+        # a definition encloses the lines if it is less indented than all the lines below it
+        indent = min((_indent(line) for line in lines[start - 1:end] if line.strip()), default=0)
+        for i in range(min(start, len(lines) + 1) - 2, max(-1, start - 2 - MAX_REGION_LINES), -1):
+            line = lines[i]
+            if not line.strip() or _indent(line) >= indent:
+                continue
+            if _DEFINITION_PATTERN.match(line):
+                first = i
+                break
+            indent = _indent(line)
+
+    if first is not None:
+        def_indent = _indent(lines[first])
+        last = None
+        for j in range(max(end, first + 1), min(len(lines), first + MAX_REGION_LINES)):
+            line = lines[j]
+            if line.strip() and _indent(line) <= def_indent:
+                last = j if _BLOCK_END_PATTERN.match(line) else j - 1
+                break
+        if last is None and first + MAX_REGION_LINES >= len(lines):
+            # the definition runs to the end of the file
+            last = len(lines) - 1
+        if last is not None:
+            while last > first and not lines[last].strip():
+                last -= 1
+            return first + 1, max(last + 1, min(end, len(lines)))
+    return max(1, start - WINDOW_LINES), min(len(lines), end + WINDOW_LINES)
+
+
+def _merge(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class BlobCache:
+    """
+    LRU cache of the file contents keyed by project, path and blob sha.
+    A blob never changes, so an entry is only evicted by size.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: tuple) -> str | None:
+        with self._lock:
+            content = self._entries.get(key)
+            if content is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return content
+
+    def put(self, key: tuple, content: str):
+        with self._lock:
+            self._entries[key] = content
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / total, 3) if total else 0.0,
+            }
+
+
+class ContextEnricher:
+    """
+    Add the enclosing function or block of each changed hunk to the changes, so the LLM sees more than the hunks.
+    The files are fetched concurrently within the concurrency limit, while the changes keep their order,
+    and the context is trimmed to the token budget of the merge request and of each file.
+    """
+
+    def __init__(self, max_tokens: int, max_file_tokens: int, concurrency: int, cache_entries: int,
+                 count: Callable[[str], int]):
+        """
+        :param max_tokens: token budget of the context of a merge request, 0 means no context
+        :param max_file_tokens: token budget of the context of a file
+        :param concurrency: files fetched at the same time
+        :param cache_entries: file contents kept in the cache
+        :param count: count the tokens of a text
+        """
+        self.max_tokens = max_tokens
+        self.max_file_tokens = max_file_tokens
+        self.concurrency = concurrency
+        self.count = count
+        self.cache = BlobCache(cache_entries)
+
+    def fetch(self, project_id: int, path: str, ref: str) -> str | None:
+        """
+        Get the content of the file at the commit, None if it is not available
+        """
+        blob = get_file_blob(project_id, path, ref)
+        if blob is None:
+            return None
+        blob_id, size = blob
+        if size > MAX_FILE_BYTES:
+            log.debug("Context: skip %s, %s bytes", path, size)
+            return None
+        key = (project_id, path, blob_id)
+        content = self.cache.get(key)
+        if content is None:
+            content = get_blob_content(project_id, blob_id)
+            if content is not None:
+                self.cache.put(key, content)
+        return content
+
+    def regions(self, change: dict, content: str) -> list[str]:
+        """
+        Enclosing regions of the hunks of the change, with their line numbers
+        """
+        lines = content.splitlines()
+        ranges = _merge([enclosing_region(lines, start, end) for start, end in hunk_ranges(change.get("diff") or "")])
+        return [
+            f"@@ {start},{end} @@\n" + "\n".join(lines[start - 1:end])
+            for start, end in ranges
+        ]
+
+    def _fetch_regions(self, project_id: int, ref: str, change: dict) -> list[str]:
+        try:
+            content = self.fetch(project_id, change["new_path"], ref)
+        except Exception as e:
+            # the context is optional, the change is still reviewed
+            log.warning(f"Context: fails to fetch {change['new_path']}: {e}")
+            return []
+        return self.regions(change, content) if content is not None else []
+
+    def iter_enrich(self, changes: Iterable[dict], project_id: int, ref: str) -> Iterator[dict]:
+        """
+        Add the context to the changes while they arrive, a change gets a "context" field if it has any
+        :param project_id: project of the changes
+        :param ref: head commit of the changes
+        """
+        if self.max_tokens <= 0:
+            yield from changes
+            return
+
+        remaining, files, enriched = self.max_tokens, 0, 0
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="review-context")
+
+        def take() -> dict:
+            nonlocal remaining, enriched
+            change, future = pending.popleft()
+            if future is None:
+                return change
+            context, tokens = [], 0
+            for region in future.result():
+                region_tokens = self.count(region)
+                if tokens + region_tokens > min(self.max_file_tokens, remaining):
+                    continue
+                context.append(region)
+                tokens += region_tokens
+            if not context:
+                return change
+            remaining -= tokens
+            enriched += 1
+            return {**change, "context": "\n".join(context)}
+
+        try:
+            for change in changes:
+                files += 1
+                # a new file is all in its diff, a deleted file has no context
+                future = None
+                if remaining > 0 and not change.get("new_file") and not change.get("deleted_file"):
+                    # the fetches share the retry budget of the review
+                    future = executor.submit(contextvars.copy_context().run,
+                                             self._fetch_regions, project_id, ref, change)
+                pending.append((change, future))
+                while len(pending) > self.concurrency:
+                    yield take()
+            while pending:
+                yield take()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        log.info(f"Context: {enriched} of {files} files, {self.max_tokens - remaining} tokens, "
+                 f"budget {self.max_tokens}")
+
+    def stats(self) -> dict:
+        return {"cache": self.cache.stats()}
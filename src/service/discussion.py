@@ -0,0 +1,65 @@
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+
+from service.gitlab_api import Note
+from utils.logger import log
+
+
+# Hidden marker in a review of the bot, the head commit reviewed
+_REVIEW_MARKER = "<!-- crbot-review head={head_sha} -->"
+_REVIEW_MARKER_PATTERN = re.compile(r"<!-- crbot-review head=([0-9a-f]{7,64}) -->")
+
+
+def review_marker(head_sha: str) -> str:
+    return _REVIEW_MARKER.format(head_sha=head_sha)
+
+
+@dataclass
+class Discussion:
+    # head commit of the latest review of the bot, None if it is not found
+    reviewed_sha: str | None = None
+    # comments of the reviewers, the oldest is the first
+    comments: list[str] = field(default_factory=list)
+    tokens: int = 0
+    notes: int = 0
+
+
+def read_discussion(notes: Iterable[Note], bot_id: int, max_tokens: int, count: Callable[[str], int],
+                    find_review: bool = True) -> Discussion:
+    """
+    Read the latest review of the bot and the newest comments of the reviewers within the token budget.
+    The notes are read from the newest, and the rest is not fetched once nothing more is needed.
+    :param notes: notes of the merge request, the newest is the first
+    :param bot_id: user id of the bot, its own notes are not part of the discussion
+    :param max_tokens: token budget of the comments, 0 means no comment is read
+    :param count: count the tokens of a text
+    :param find_review: look for the latest review of the bot
+    """
+    discussion = Discussion()
+    full = max_tokens <= 0
+    for note in notes:
+        if full and (discussion.reviewed_sha is not None or not find_review):
+            break
+        discussion.notes += 1
+        if note.author_id == bot_id:
+            if discussion.reviewed_sha is None:
+                marker = _REVIEW_MARKER_PATTERN.search(note.body)
+                if marker is not None:
+                    discussion.reviewed_sha = marker.group(1)
+            continue
+        if note.system or full:
+            continue
+        comment = f"@{note.author}: {note.body.strip()}"
+        tokens = count(comment)
+        if discussion.tokens + tokens > max_tokens:
+            # the older comments are dropped too, so the kept comments are a continuous discussion
+            full = True
+            continue
+        discussion.comments.append(comment)
+        discussion.tokens += tokens
+
+    discussion.comments.reverse()
+    log.info(f"Discussion: read {discussion.notes} notes, keep {len(discussion.comments)} comments, "
+             f"{discussion.tokens} tokens, reviewed head {discussion.reviewed_sha}")
+    return discussion
@@ -1,7 +1,6 @@
 # -*- coding: utf-8 -*-
 import urllib.parse
-import requests
-from config.config import gitlab_private_token, gitlab_server_url
+from service.gitlab_client import gitlab
 from utils.logger import log
 
 
@@ -21,13 +20,9 @@ def get_gitlab_file_content(project_id, file_path, version):
     :param version: branch or tag
     :return: if request is ok return file content else return None
     """
-
-    headers = {
-        'PRIVATE-TOKEN': gitlab_private_token
-    }
     file_path = encode_file_path(file_path)
-    url = f'{gitlab_server_url}/api/v4/projects/{project_id}/repository/files/{file_path}/raw?ref={version}'
-    response = requests.get(url, headers=headers)
+    url = f'/projects/{project_id}/repository/files/{file_path}/raw'
+    response = gitlab.get(url, params={'ref': version})
 
     if response.status_code == 200:
         log.info(f'{url} API请求成功：{response.status_code} {response.reason}')
@@ -36,3 +31,34 @@ def get_gitlab_file_content(project_id, file_path, version):
     else:
         log.error(f'{url} API请求失败：{response.status_code} {response.reason}')
         return None
+
+
+def get_file_blob(project_id, file_path, version) -> tuple[str, int] | None:
+    """
+    get the blob id and the size of a file without its content
+    :param project_id: Project ID
+    :param file_path: file path
+    :param version: commit sha, branch or tag
+    :return: blob id and size in bytes, None if the file does not exist
+    """
+    url = f'/projects/{project_id}/repository/files/{encode_file_path(file_path)}'
+    response = gitlab.head(url, params={'ref': version})
+    if response.status_code != 200:
+        log.error(f'{url} API请求失败：{response.status_code} {response.reason}')
+        return None
+    return response.headers['X-Gitlab-Blob-Id'], int(response.headers.get('X-Gitlab-Size', 0))
+
+
+def get_blob_content(project_id, blob_id) -> str | None:
+    """
+    get the content of a blob, a blob never changes
+    :param project_id: Project ID
+    :param blob_id: blob sha
+    :return: if request is ok return file content else return None
+    """
+    url = f'/projects/{project_id}/repository/blobs/{blob_id}/raw'
+    response = gitlab.get(url)
+    if response.status_code != 200:
+        log.error(f'{url} API请求失败：{response.status_code} {response.reason}')
+        return None
+    return response.content.decode('utf-8', errors='replace')
@@ -1,41 +1,94 @@
+from dataclasses import dataclass
+from functools import partial
+from typing import Iterator
+from urllib.parse import parse_qs, urlparse
+
 import requests
-from retrying import retry
 
-from config.config import *
-from utils.logger import log
+from service.gitlab_client import gitlab
+from service.project_cache import metadata_cache
+from utils.logger import Truncated, log
+from utils.metrics import REVIEW_OUTCOMES
 
 
 # Constants
 LABEL_WIP = "CrBot WIP"
 LABEL_DONE = "CrBot Done"
 LABEL_FAILED = "CrBot Failed"
+LABEL_BUSY = "CrBot Busy"
 
+LABEL_COLORS = {
+    LABEL_WIP: "#eee600",
+    LABEL_DONE: "#009966",
+    LABEL_FAILED: "#dc143c",
+    LABEL_BUSY: "#8fbc8f",
+}
 
-headers = {"Private-Token": gitlab_private_token}
-
+# Changed files in a page of the merge request diffs
+DIFFS_PER_PAGE = 20
+# Notes in a page of the merge request notes
+NOTES_PER_PAGE = 100
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
-def get_merge_request_comments(project_id, merge_request_iid):
-    url = f"{gitlab_server_url}/api/v4/projects/{project_id}/merge_requests/{merge_request_iid}/notes"
 
-    response = requests.get(url, headers=headers)
+@dataclass(frozen=True)
+class Note:
+    """A note of a merge request, without the fields the bot does not use"""
+    id: int
+    author_id: int
+    author: str
+    body: str
+    system: bool
+    created_at: str
 
-    comments_content = ""
-    if response.status_code == 200:
-        comments = response.json()
-        for comment in comments:
-            author_username = comment['author']['username']
-            comment_body = comment['body']
-            print(f"Author: {author_username}")
-            print(f"Comment: {comment_body}")
-            comments_content += comment_body
 
-    else:
-        log.error(f"Failed to get comments. Status code: {response.status_code}")
-    return comments_content
+def next_page(response: requests.Response) -> int | None:
+    """
+    Number of the next page of a paginated response, by the X-Next-Page header or the Link header
+    :return: None if it is the last page
+    """
+    page = response.headers.get("X-Next-Page")
+    if page:
+        return int(page)
+    link = response.links.get("next")
+    if link:
+        query = parse_qs(urlparse(link["url"]).query)
+        if query.get("page"):
+            return int(query["page"][0])
+    return None
+
+
+def iter_merge_request_notes(project_id, merge_request_iid, newest_first: bool = True,
+                             per_page: int = NOTES_PER_PAGE) -> Iterator[Note]:
+    """
+    Notes of the merge request, the pages are fetched while they are iterated,
+    so the rest is not fetched if the caller stops early
+    :param newest_first: the newest note is the first
+    :return:
+    """
+    path = f"/projects/{project_id}/merge_requests/{merge_request_iid}/notes"
+    params = {"order_by": "created_at", "sort": "desc" if newest_first else "asc", "per_page": per_page}
+    while True:
+        response = gitlab.get(path, params=params)
+        if response.status_code != 200:
+            log.error(f"Fails to get notes of merge request {merge_request_iid}, page {params.get('page', 1)}, "
+                      f"status code: {response.status_code}")
+            raise Exception(f"Fails to get notes of merge request {merge_request_iid}, "
+                            f"status code: {response.status_code}")
+        for note in response.json():
+            yield Note(
+                id=note["id"],
+                author_id=note["author"]["id"],
+                author=note["author"]["username"],
+                body=note["body"],
+                system=note.get("system", False),
+                created_at=note["created_at"],
+            )
+        page = next_page(response)
+        if page is None:
+            return
+        params = {**params, "page": page}
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
 def get_commit_change_file(push_info):
     commit_list = push_info['commits']
     added_files_list = []
@@ -49,37 +102,42 @@ def get_commit_change_file(push_info):
     return added_files_list + modified_files_list
 
 
-__gitlab_user_id = None
-
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
 def get_user_id():
-    global __gitlab_user_id
-    if __gitlab_user_id:
-        return __gitlab_user_id
-    url = f"{gitlab_server_url}/api/v4/user"
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        user_info = response.json()
-        __gitlab_user_id = user_info['id']
-        return __gitlab_user_id
-    else:
-        log.error(f"Falied to get user id. Status code: {response.status_code}")
-        raise Exception(f"Falied to get user id. Status code: {response.status_code}")
+    """
+    Get the user id of the bot, it is cached
+    :return:
+    """
+    try:
+        return metadata_cache.get("user", "/user", lambda response: response.json()["id"])
+    except Exception as e:
+        log.error(f"Falied to get user id: {e}")
+        raise
+
+
+def get_cached_user_id() -> int | None:
+    """
+    Get the user id of the bot without any request
+    :return: None if it is not fetched yet
+    """
+    return metadata_cache.peek("user")
 
 
 def get_project_labels(project_id: int) -> list[str]:
     """
-    Get the labels of the project
+    Get the bot labels of the project, it is cached
     :param project_id:
     :return:
     """
-    url = f"{gitlab_server_url}/api/v4/projects/{project_id}/labels"
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return [label["name"] for label in response.json()]
-    else:
-        log.error(f"Fails to get labels, status code: {response.status_code}")
-        raise Exception(f"Fails to get labels, status code: {response.status_code}")
+    try:
+        return metadata_cache.get(
+            f"labels:{project_id}",
+            f"/projects/{project_id}/labels",
+            lambda response: [label["name"] for label in response.json()],
+            params={"search": "CrBot", "per_page": 100}
+        )
+    except Exception as e:
+        log.error(f"Fails to get labels: {e}")
+        raise
 
 
 def add_project_label(project_id: int, name: str, color: str):
@@ -90,21 +148,23 @@ def add_project_label(project_id: int, name: str, color: str):
     :param color:
     :return:
     """
-    url = f"{gitlab_server_url}/api/v4/projects/{project_id}/labels"
     data = {
         "name": name,
         "color": color
     }
-    response = requests.post(url, headers=headers, json=data)
+    response = gitlab.post(f"/projects/{project_id}/labels", json=data)
     if response.status_code == 201:
         log.info(f"Succeed to add label {name}")
+        metadata_cache.update(f"labels:{project_id}", lambda labels: labels + [name])
+    elif response.status_code == 409:
+        # the label is added by another worker, or the cached labels are stale
+        log.info(f"Label {name} already exists")
+        metadata_cache.invalidate(f"labels:{project_id}")
     else:
         log.error(f"Fails to add label {name}, status code: {response.status_code}")
         raise Exception(f"Fails to add label {name}, status code: {response.status_code}")
 
 
-
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
 def create_project_labels(project_id: int):
     """
     Create labels for the project
@@ -112,15 +172,18 @@ def create_project_labels(project_id: int):
     :return:
     """
     labels = get_project_labels(project_id)
-    if LABEL_WIP not in labels:
-        add_project_label(project_id, LABEL_WIP, "#eee600")
-    if LABEL_DONE not in labels:
-        add_project_label(project_id, LABEL_DONE, "#009966")
-    if LABEL_FAILED not in labels:
-        add_project_label(project_id, LABEL_FAILED, "#dc143c")
+    if all(name in labels for name in LABEL_COLORS):
+        return
+    calls = {
+        name: partial(add_project_label, project_id, name, color)
+        for name, color in LABEL_COLORS.items()
+        if name not in labels
+    }
+    _, errors = gitlab.gather(calls)
+    if errors:
+        raise Exception(f"Fails to add labels {list(errors)}: {list(errors.values())}")
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
 def add_comment_to_mr(project_id, merge_request_id, comment):
     """
     Add a comment to a GitLab Merge Request
@@ -132,27 +195,20 @@ def add_comment_to_mr(project_id, merge_request_id, comment):
     :param comment: Comment to add
     :return: Response JSON
     """
-    headers = {
-        "Private-Token": gitlab_private_token,
-        "Content-Type": "application/json"
-    }
-
-    url = f"{gitlab_server_url}/api/v4/projects/{project_id}/merge_requests/{merge_request_id}/notes"
     data = {
         "body": comment
     }
 
-    response = requests.post(url, headers=headers, json=data)
+    response = gitlab.post(f"/projects/{project_id}/merge_requests/{merge_request_id}/notes", json=data)
 
     if response.status_code == 201:
-        log.info(f"Send comment success: project_id:{project_id}  merge_request_id:{merge_request_id}")
+        log.info("Send comment success: project_id:%s  merge_request_id:%s", project_id, merge_request_id)
         return response.json()
     else:
         log.error(f"Send comment failed: project_id:{project_id}  merge_request_id:{merge_request_id} response:{response}")
         response.raise_for_status()
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
 def post_comments(project_id: int, commit_id: int, content: str):
     """
     add comment for gitlab's commits
@@ -164,9 +220,8 @@ def post_comments(project_id: int, commit_id: int, content: str):
     data = {
         'note': content
     }
-    comments_url = f'{gitlab_server_url}/api/v4/projects/{project_id}/repository/commits/{commit_id}/comments'
-    response = requests.post(comments_url, headers=headers, json=data)
-    log.debug(f"Response: {response.json}")
+    response = gitlab.post(f"/projects/{project_id}/repository/commits/{commit_id}/comments", json=data)
+    log.debug("Response: %s", Truncated(response.text))
     if response.status_code == 201:
         comment_data = response.json()
         log.info(f"Succeed to add comment for commit {commit_id}, comment id: {comment_data['id']}")
@@ -174,7 +229,6 @@ def post_comments(project_id: int, commit_id: int, content: str):
         log.error(f"Fails to add comment for commit {commit_id}, status code: {response.status_code}")
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
 def set_approve(project_id: int, merge_request_id: int):
     """
     Set the merge request to approved
@@ -182,10 +236,9 @@ def set_approve(project_id: int, merge_request_id: int):
     :param merge_request_id:
     :return:
     """
-    url = f"{gitlab_server_url}/api/v4/projects/{project_id}/merge_requests/{merge_request_id}/approve"
-    response = requests.post(url, headers=headers)
+    response = gitlab.post(f"/projects/{project_id}/merge_requests/{merge_request_id}/approve")
     if response.status_code == 201:
-        log.info(f"Succeed to approve merge request {merge_request_id}")
+        log.info("Succeed to approve merge request %s", merge_request_id)
     else:
         log.error(f"Fails to approve merge request {merge_request_id}, status code: {response.status_code}")
         raise Exception(f"Fails to approve merge request {merge_request_id}, status code: {response.status_code}")
@@ -198,20 +251,18 @@ def set_project_label(project_id: int, merge_request_id: int, add_labels: list[s
     :param merge_request_id:
     :return:
     """
-    url = f"{gitlab_server_url}/api/v4/projects/{project_id}/merge_requests/{merge_request_id}"
     data = {
         "add_labels": add_labels,
         "remove_labels": remove_labels
     }
-    response = requests.put(url, headers=headers, json=data)
+    response = gitlab.put(f"/projects/{project_id}/merge_requests/{merge_request_id}", json=data)
     if response.status_code == 200:
-        log.info(f"Succeed to set labels for merge request {merge_request_id}")
+        log.info("Succeed to set labels for merge request %s", merge_request_id)
     else:
         log.error(f"Fails to set labels for merge request {merge_request_id}, status code: {response.status_code}")
         raise Exception(f"Fails to set labels for merge request {merge_request_id}, status code: {response.status_code}")
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
 def set_label_wip(project_id: int, merge_request_id: int):
     """
     Set the merge request to WIP
@@ -219,10 +270,9 @@ def set_label_wip(project_id: int, merge_request_id: int):
     :param merge_request_id:
     :return:
     """
-    set_project_label(project_id, merge_request_id, [LABEL_WIP], [LABEL_DONE, LABEL_FAILED])
+    set_project_label(project_id, merge_request_id, [LABEL_WIP], [LABEL_DONE, LABEL_FAILED, LABEL_BUSY])
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
 def set_label_done(project_id: int, merge_request_id: int):
     """
     Set the merge request to Done
@@ -231,9 +281,9 @@ def set_label_done(project_id: int, merge_request_id: int):
     :return:
     """
     set_project_label(project_id, merge_request_id, [LABEL_DONE], [LABEL_WIP, LABEL_FAILED])
+    REVIEW_OUTCOMES.labels("done").inc()
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
 def set_label_failed(project_id: int, merge_request_id: int):
     """
     Set the merge request to Failed
@@ -242,18 +292,124 @@ def set_label_failed(project_id: int, merge_request_id: int):
     :return:
     """
     set_project_label(project_id, merge_request_id, [LABEL_FAILED], [LABEL_WIP, LABEL_DONE])
+    REVIEW_OUTCOMES.labels("failed").inc()
+
+
+def set_label_busy(project_id: int, merge_request_id: int):
+    """
+    Set the merge request to Busy, the review queue is full and the review is not started
+    :param project_id:
+    :param merge_request_id:
+    :return:
+    """
+    set_project_label(project_id, merge_request_id, [LABEL_BUSY], [LABEL_WIP, LABEL_DONE, LABEL_FAILED])
+    REVIEW_OUTCOMES.labels("busy").inc()
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000)
-def get_merge_request_changes(project_id, merge_id):
-    # URL for the GitLab API endpoint
-    url = f"{gitlab_server_url}/api/v4/projects/{project_id}/merge_requests/{merge_id}/changes"
+class MergeRequestDiffs:
+    """
+    Changed files of a merge request, fetched from the paginated diffs api page by page while they are iterated,
+    so only one page is held in memory. The first page is fetched at once to get the total number of files.
+    """
+
+    def __init__(self, project_id, merge_id, per_page: int = DIFFS_PER_PAGE):
+        self.path = f"/projects/{project_id}/merge_requests/{merge_id}/diffs"
+        self.merge_id = merge_id
+        self.per_page = per_page
+        self._legacy = None
+        self._response = self._fetch(1)
+        if self._response is None:
+            # the diffs api is added in GitLab 15.7
+            self._legacy = self._fetch_changes(project_id, merge_id)
+            self.total = len(self._legacy)
+        else:
+            # GitLab omits the total of a very large merge request
+            total = self._response.headers.get("X-Total")
+            self.total = int(total) if total else None
+
+    def _fetch(self, page: int) -> requests.Response | None:
+        response = gitlab.get(self.path, params={"page": page, "per_page": self.per_page})
+        if response.status_code == 404 and page == 1:
+            return None
+        if response.status_code != 200:
+            log.error(f"Fails to get diffs of merge request {self.merge_id}, page {page}, "
+                      f"status code: {response.status_code}")
+            raise Exception(f"Fails to get diffs of merge request {self.merge_id}, status code: {response.status_code}")
+        return response
+
+    def _fetch_changes(self, project_id, merge_id) -> list[dict]:
+        response = gitlab.get(f"/projects/{project_id}/merge_requests/{merge_id}/changes")
+        if response.status_code != 200:
+            raise Exception(f"Fails to get changes of merge request {merge_id}, status code: {response.status_code}")
+        result = response.json()
+        if result.get("overflow"):
+            log.warning(f"Changes of merge request {merge_id} are truncated by GitLab")
+        return result["changes"]
+
+    def __iter__(self) -> Iterator[dict]:
+        if self._legacy is not None:
+            yield from self._legacy
+            return
+        response, self._response = self._response, None
+        if response is None:
+            raise RuntimeError("The diffs of a merge request can be iterated only once")
+        while True:
+            yield from response.json()
+            page = next_page(response)
+            if page is None:
+                return
+            response = self._fetch(page)
+
+
+def get_merge_request_versions(project_id, merge_id) -> list[dict]:
+    """
+    Get the diff versions of the merge request, the latest version is the first
+    :param project_id:
+    :param merge_id:
+    :return:
+    """
+    response = gitlab.get(f"/projects/{project_id}/merge_requests/{merge_id}/versions", params={"per_page": 100})
+    if response.status_code == 200:
+        return response.json()
+    else:
+        log.error(f"Fails to get versions of merge request {merge_id}, status code: {response.status_code}")
+        raise Exception(f"Fails to get versions of merge request {merge_id}, status code: {response.status_code}")
 
-    # Make the GET request
-    response = requests.get(url, headers=headers)
 
-    # Check if the request was successful
+def compare_commits(project_id, from_sha: str, to_sha: str) -> list[dict] | None:
+    """
+    Get the changes from one commit straight to another, in the same format as the merge request changes
+    :param project_id:
+    :param from_sha:
+    :param to_sha:
+    :return: None if the commits can not be compared, e.g. the old commit is gone after a force push
+    """
+    response = gitlab.get(
+        f"/projects/{project_id}/repository/compare", params={"from": from_sha, "to": to_sha, "straight": "true"}
+    )
     if response.status_code == 200:
-        return response.json()["changes"]
+        return response.json()["diffs"]
     else:
+        log.error(f"Fails to compare {from_sha}...{to_sha}, status code: {response.status_code}")
         return None
+
+
+def finish_review(project_id: int, merge_request_id: int, comment: str):
+    """
+    Post the review comment, then set the Done label and approve the merge request concurrently,
+    a merge request is never labeled done or approved without its review comment
+    :param project_id:
+    :param merge_request_id:
+    :param comment:
+    :return:
+    """
+    add_comment_to_mr(project_id, merge_request_id, comment)
+    _, errors = gitlab.gather({
+        "label": partial(set_label_done, project_id, merge_request_id),
+        "approve": partial(set_approve, project_id, merge_request_id),
+    })
+    if "approve" in errors:
+        # the bot may not be allowed to approve, the review is still done
+        log.warning(f"Fails to approve merge request {merge_request_id}: {errors.pop('approve')}")
+    if errors:
+        raise Exception(f"Fails to finish review of merge request {merge_request_id}: {errors}")
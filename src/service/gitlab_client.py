@@ -0,0 +1,253 @@
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from config.config import (
+    circuit_failure_threshold,
+    circuit_recovery_seconds,
+    gitlab_pool_size,
+    gitlab_private_token,
+    gitlab_retry_attempts,
+    gitlab_retry_base_seconds,
+    gitlab_retry_cap_seconds,
+    gitlab_server_url,
+    gitlab_timeout_seconds
+)
+from utils.logger import log
+from utils.metrics import GITLAB_ERRORS, GITLAB_REQUEST_SECONDS
+from utils.resilience import CircuitBreaker, RetryPolicy, call_with_retry
+from utils.tracing import span
+
+
+# Ids and url encoded paths are replaced, so the latency is grouped by endpoint
+_ENDPOINT_PATTERNS = [
+    (re.compile(r"/repository/files/[^/]+"), "/repository/files/:path"),
+    (re.compile(r"/repository/blobs/[0-9a-f]+"), "/repository/blobs/:sha"),
+    (re.compile(r"/\d+(?=/|$)"), "/:id"),
+]
+
+
+# A request with these status codes is not processed by GitLab, it is retried
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+# A request with these status codes may be processed, only idempotent requests are retried
+IDEMPOTENT_RETRY_STATUS_CODES = {500}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+
+
+class RetryableStatus(Exception):
+    def __init__(self, response: requests.Response):
+        super().__init__(f"status code: {response.status_code}")
+        self.response = response
+
+
+def is_retryable(method: str, exception: Exception) -> bool:
+    """
+    Whether a failed request is transient and safe to send again
+    """
+    idempotent = method in IDEMPOTENT_METHODS
+    if isinstance(exception, RetryableStatus):
+        status = exception.response.status_code
+        return status in RETRY_STATUS_CODES or (idempotent and status in IDEMPOTENT_RETRY_STATUS_CODES)
+    if isinstance(exception, requests.ConnectionError):
+        # a connection closed after the request is sent, e.g. a stale keep-alive connection, may be processed
+        return idempotent or is_not_sent(exception)
+    if isinstance(exception, requests.Timeout):
+        # a comment may be posted even if the response times out
+        return idempotent
+    return False
+
+
+def is_not_sent(exception: requests.ConnectionError) -> bool:
+    """
+    Whether the request failed while connecting, before it is sent
+    """
+    if isinstance(exception, requests.ConnectTimeout):
+        return True
+    # requests wraps the error of urllib3 in a MaxRetryError
+    reason = exception.args[0] if exception.args else None
+    return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+
+
+def endpoint_of(path: str) -> str:
+    """
+    Endpoint name of the api path, e.g. /projects/:id/merge_requests/:id/notes
+    """
+    for pattern, repl in _ENDPOINT_PATTERNS:
+        path = pattern.sub(repl, path)
+    return path
+
+
+class GitLabClient:
+    """
+    GitLab API client sharing a pool of keep-alive connections between all the threads of a process.
+    Transient failures are retried with backoff, and the requests fail at once while GitLab is down.
+    """
+
+    def __init__(self, server_url: str, private_token: str, pool_size: int, timeout: float,
+                 retry_policy: RetryPolicy, breaker: CircuitBreaker):
+        self.api_url = f"{server_url.rstrip('/')}/api/v4"
+        self.private_token = private_token
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retry_policy = retry_policy
+        self.breaker = breaker
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session = None
+        self._adapter = None
+        self._executor = None
+        self._endpoints: dict[str, dict] = {}
+
+    def _get_session(self) -> requests.Session:
+        # a session must not be shared with the forked gunicorn workers
+        with self._lock:
+            if self._pid != os.getpid():
+                session = requests.Session()
+                session.headers.update({"Private-Token": self.private_token})
+                # pool_block is off, a burst of greenlets opens extra connections instead of waiting
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, pool_block=False)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session, self._adapter, self._pid = session, adapter, os.getpid()
+                # threads are greenlets with gevent workers
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="gitlab")
+                self._endpoints = {}
+            return self._session
+
+    def gather(self, calls: dict[str, Callable[[], Any]]) -> tuple[dict[str, Any], dict[str, Exception]]:
+        """
+        Run independent api calls concurrently and wait for all of them, a failed call does not cancel the others.
+        The calls run in a copy of the current context, so they share the retry budget of the job.
+        The calls must not call gather themselves.
+        :param calls: calls by name, e.g. {"comment": partial(add_comment_to_mr, 1, 2, "LGTM")}
+        :return: results and exceptions by name
+        """
+        self._get_session()
+        start = time.monotonic()
+        futures = {
+            name: self._executor.submit(contextvars.copy_context().run, call)
+            for name, call in calls.items()
+        }
+        results, errors = {}, {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+        log.debug("GitLab gather %s in %.0fms, failed: %s",
+                  list(calls), (time.monotonic() - start) * 1000, list(errors))
+        return results, errors
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Send a request to the GitLab API
+        :param method: http method
+        :param path: api path, e.g. /projects/1/labels
+        :param kwargs: arguments of requests, the default timeout is used if it is not given
+        :return: the response, or the last response if the retries of a transient status code are exhausted
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            return call_with_retry(
+                partial(self._send, method, path, **kwargs),
+                self.breaker, self.retry_policy, partial(is_retryable, method)
+            )
+        except RetryableStatus as e:
+            return e.response
+
+    def _send(self, method: str, path: str, **kwargs) -> requests.Response:
+        session = self._get_session()
+        endpoint = f"{method} {endpoint_of(path)}"
+
+        start = time.monotonic()
+        with span("gitlab", endpoint=endpoint) as current:
+            try:
+                response = session.request(method, f"{self.api_url}{path}", **kwargs)
+            except requests.RequestException:
+                self._record(endpoint, time.monotonic() - start, error=True)
+                raise
+            if current is not None:
+                current.attributes["status"] = response.status_code
+        elapsed = time.monotonic() - start
+        self._record(endpoint, elapsed, error=response.status_code >= 400)
+
+        if log.isEnabledFor(logging.DEBUG):
+            connections, requests_sent = self._connection_usage()
+            log.debug("GitLab %s: %s in %.0fms, %s connections for %s requests",
+                      endpoint, response.status_code, elapsed * 1000, connections, requests_sent)
+        if response.status_code in RETRY_STATUS_CODES | IDEMPOTENT_RETRY_STATUS_CODES:
+            raise RetryableStatus(response)
+        return response
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def head(self, path: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request("PUT", path, **kwargs)
+
+    def _record(self, endpoint: str, elapsed: float, error: bool):
+        GITLAB_REQUEST_SECONDS.labels(endpoint).observe(elapsed)
+        if error:
+            GITLAB_ERRORS.labels(endpoint).inc()
+        with self._lock:
+            stat = self._endpoints.setdefault(endpoint, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0})
+            stat["count"] += 1
+            stat["errors"] += int(error)
+            stat["total"] += elapsed
+            stat["max"] = max(stat["max"], elapsed)
+
+    def _connection_usage(self) -> tuple[int, int]:
+        """
+        Number of opened connections and sent requests of all the connection pools
+        """
+        if self._adapter is None:
+            return 0, 0
+        pools = [self._adapter.poolmanager.pools[key] for key in self._adapter.poolmanager.pools.keys()]
+        return sum(pool.num_connections for pool in pools), sum(pool.num_requests for pool in pools)
+
+    def stats(self) -> dict:
+        """
+        Get the connection reuse rate and the latency of each endpoint of the current process
+        """
+        connections, requests_sent = self._connection_usage()
+        with self._lock:
+            endpoints = {
+                endpoint: {
+                    "count": stat["count"],
+                    "errors": stat["errors"],
+                    "avg_ms": round(stat["total"] / stat["count"] * 1000, 1),
+                    "max_ms": round(stat["max"] * 1000, 1),
+                }
+                for endpoint, stat in self._endpoints.items()
+            }
+        return {
+            "pool_size": self.pool_size,
+            "connections": connections,
+            "requests": requests_sent,
+            "reuse_rate": round(1 - connections / requests_sent, 3) if requests_sent else 0.0,
+            "circuit": self.breaker.stats(),
+            "endpoints": endpoints,
+        }
+
+
+gitlab = GitLabClient(
+    gitlab_server_url, gitlab_private_token, gitlab_pool_size, gitlab_timeout_seconds,
+    RetryPolicy(gitlab_retry_attempts, gitlab_retry_base_seconds, gitlab_retry_cap_seconds),
+    CircuitBreaker("gitlab", circuit_failure_threshold, circuit_recovery_seconds)
+)
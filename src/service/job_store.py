@@ -0,0 +1,438 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from config.config import review_job_db
+from utils.logger import log
+
+
+# Job status
+STATUS_ENQUEUED = "enqueued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+# Result of enqueue
+ENQUEUED = "enqueued"
+COALESCED = "coalesced"
+DUPLICATE = "duplicate"
+FULL = "full"
+
+
+@dataclass
+class Job:
+    id: int
+    project_id: int
+    mr_id: int
+    payload: dict
+    head_sha: str | None
+    attempts: int
+    enqueued_at: float
+    started_at: float
+    cost: int | None = None
+    priority: int = 0
+    trace_id: str | None = None
+
+
+class JobStore:
+    """
+    Persistent review job queue backed by SQLite, shared by all the worker processes on a host.
+    A worker claims a job with a lease, a job whose lease is expired is claimed again by another worker.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    project_id INTEGER NOT NULL,
+                    mr_id INTEGER NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    enqueued_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    error TEXT
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, enqueued_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_mr ON jobs (project_id, mr_id, status)")
+            self._add_columns(conn, "jobs", {
+                "head_sha": "TEXT",
+                "not_before": "REAL NOT NULL DEFAULT 0",
+                "cancel_requested": "INTEGER NOT NULL DEFAULT 0",
+                "cost": "INTEGER",
+                "priority": "INTEGER NOT NULL DEFAULT 0",
+                "estimate_started_at": "REAL",
+                "trace_id": "TEXT",
+            })
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS reviewed_heads (
+                    project_id INTEGER NOT NULL,
+                    mr_id INTEGER NOT NULL,
+                    head_sha TEXT NOT NULL,
+                    reviewed_at REAL NOT NULL,
+                    PRIMARY KEY (project_id, mr_id)
+                )
+                """
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # a connection must not be shared with the forked gunicorn workers
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _add_columns(conn: sqlite3.Connection, table: str, columns: dict[str, str]):
+        """
+        Add the columns missing in a job store created by an older version
+        """
+        existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, declaration in columns.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {declaration}")
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def owner_id() -> str:
+        """
+        Lease owner of the current worker thread
+        """
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+    def enqueue(self, project_id: int, mr_id: int, payload: dict, head_sha: str | None = None,
+                delay_seconds: float = 0, max_pending: int = 0, priority: int = 0,
+                trace_id: str | None = None) -> tuple[int | None, str]:
+        """
+        Add a job to the queue, events of the same merge request are coalesced:
+        - an enqueued job of the merge request takes the new payload and waits for another quiet window,
+          its cost is estimated again, but it keeps its place in time
+        - a running job of an older head commit is asked to stop, it is superseded by the new job
+        - a running job of the same head commit makes the new event a duplicate
+        :param head_sha: head commit of the merge request in the event
+        :param delay_seconds: quiet window, the job is not claimed before it ends
+        :param max_pending: maximum number of enqueued jobs, 0 means unlimited
+        :param priority: number of priority boosts of the job
+        :param trace_id: trace of the event, a coalesced job keeps the trace of its first event
+        :return: job id, and ENQUEUED, COALESCED, DUPLICATE or FULL
+        """
+        now = time.time()
+        payload_json = json.dumps(payload, ensure_ascii=False)
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, status, head_sha FROM jobs WHERE project_id = ? AND mr_id = ? AND status IN (?, ?)",
+                (project_id, mr_id, STATUS_ENQUEUED, STATUS_RUNNING)
+            ).fetchall()
+
+            enqueued = [row for row in rows if row["status"] == STATUS_ENQUEUED]
+            running = [row for row in rows if row["status"] == STATUS_RUNNING]
+            for row in running:
+                if head_sha is not None and row["head_sha"] == head_sha:
+                    if not enqueued:
+                        return row["id"], DUPLICATE
+                    continue
+                conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (row["id"],))
+                log.info("Review job %s of %s is superseded by %s", row['id'], row['head_sha'], head_sha)
+            if enqueued:
+                conn.execute(
+                    """
+                    UPDATE jobs SET payload = ?, head_sha = ?, not_before = ?, priority = ?,
+                        cost = NULL, estimate_started_at = NULL
+                    WHERE id = ?
+                    """,
+                    (payload_json, head_sha, now + delay_seconds, priority, enqueued[0]["id"])
+                )
+                return enqueued[0]["id"], COALESCED
+
+            if max_pending > 0:
+                pending = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ?", (STATUS_ENQUEUED,)
+                ).fetchone()[0]
+                if pending >= max_pending:
+                    return None, FULL
+            cursor = conn.execute(
+                """
+                INSERT INTO jobs (project_id, mr_id, payload, head_sha, status, enqueued_at, not_before, priority,
+                    trace_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (project_id, mr_id, payload_json, head_sha, STATUS_ENQUEUED, now, now + delay_seconds, priority,
+                 trace_id)
+            )
+            return cursor.lastrowid, ENQUEUED
+
+    def cancel(self, project_id: int, mr_id: int) -> int:
+        """
+        Cancel the enqueued jobs of the merge request, and ask the running one to stop
+        :return: number of cancelled jobs
+        """
+        with self._transaction() as conn:
+            cancelled = conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE project_id = ? AND mr_id = ? AND status = ?",
+                (STATUS_CANCELLED, time.time(), project_id, mr_id, STATUS_ENQUEUED)
+            ).rowcount
+            stopping = conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE project_id = ? AND mr_id = ? AND status = ?",
+                (project_id, mr_id, STATUS_RUNNING)
+            ).rowcount
+            return cancelled + stopping
+
+    def is_cancelled(self, job_id: int) -> bool:
+        """
+        Whether the running job is asked to stop
+        """
+        row = self._connection().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is None or bool(row["cancel_requested"])
+
+    def claim(self, owner: str, lease_seconds: float, default_cost: int = 0, aging_per_second: float = 0,
+              priority_boost: int = 0) -> Job | None:
+        """
+        Claim a running job whose lease is expired, or the enqueued job with the lowest score
+        whose quiet window is over. The score is the estimated cost in tokens, minus the aging
+        of the time in queue and the priority boosts, so the cheap jobs go first and a large
+        job can not starve. The jobs are claimed in arrival order with the default arguments.
+        :param default_cost: cost of a job that is not estimated yet
+        :param aging_per_second: cost taken off for each second in queue
+        :param priority_boost: cost taken off for each priority boost
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                """
+                SELECT *, COALESCE(cost, ?) - (? - enqueued_at) * ? - priority * ? AS score FROM jobs
+                WHERE (status = ? AND not_before <= ?) OR (status = ? AND lease_expires < ?)
+                ORDER BY status = ? DESC, score, enqueued_at LIMIT 1
+                """,
+                (default_cost, now, aging_per_second, priority_boost,
+                 STATUS_ENQUEUED, now, STATUS_RUNNING, now, STATUS_RUNNING)
+            ).fetchone()
+            if row is None:
+                return None
+            if row["status"] == STATUS_RUNNING:
+                log.warning(f"Lease of job {row['id']} held by {row['lease_owner']} is expired, resume it")
+            conn.execute(
+                """
+                UPDATE jobs SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires = ?,
+                    started_at = ?
+                WHERE id = ?
+                """,
+                (STATUS_RUNNING, owner, now + lease_seconds, now, row["id"])
+            )
+        return Job(
+            id=row["id"],
+            project_id=row["project_id"],
+            mr_id=row["mr_id"],
+            payload=json.loads(row["payload"]),
+            head_sha=row["head_sha"],
+            attempts=row["attempts"] + 1,
+            enqueued_at=row["enqueued_at"],
+            started_at=now,
+            cost=row["cost"],
+            priority=row["priority"],
+            trace_id=row["trace_id"],
+        )
+
+    def claim_estimate(self, retry_seconds: float) -> Job | None:
+        """
+        Claim an enqueued job whose cost is not estimated yet, so it is estimated by one process only
+        :param retry_seconds: the job is estimated again if no cost is set in this time
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                """
+                SELECT * FROM jobs
+                WHERE status = ? AND cost IS NULL AND (estimate_started_at IS NULL OR estimate_started_at < ?)
+                ORDER BY enqueued_at LIMIT 1
+                """,
+                (STATUS_ENQUEUED, now - retry_seconds)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE jobs SET estimate_started_at = ? WHERE id = ?", (now, row["id"]))
+        return Job(
+            id=row["id"],
+            project_id=row["project_id"],
+            mr_id=row["mr_id"],
+            payload=json.loads(row["payload"]),
+            head_sha=row["head_sha"],
+            attempts=row["attempts"],
+            enqueued_at=row["enqueued_at"],
+            started_at=0.0,
+            priority=row["priority"],
+        )
+
+    def set_cost(self, job_id: int, head_sha: str | None, cost: int):
+        """
+        Set the estimated cost of an enqueued job, unless it is coalesced with a newer commit meanwhile
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET cost = ? WHERE id = ? AND status = ? AND head_sha IS ?",
+                (cost, job_id, STATUS_ENQUEUED, head_sha)
+            )
+
+    def renew(self, job_id: int, owner: str, lease_seconds: float) -> bool:
+        """
+        Extend the lease of a running job
+        :return: False if the job is not held by the owner anymore
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                (time.time() + lease_seconds, job_id, STATUS_RUNNING, owner)
+            )
+            return cursor.rowcount == 1
+
+    def finish(self, job_id: int, owner: str, error: str | None = None, cancelled: bool = False):
+        """
+        Mark a running job as done, failed if error is given, or cancelled
+        """
+        if cancelled:
+            status = STATUS_CANCELLED
+        else:
+            status = STATUS_FAILED if error is not None else STATUS_DONE
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                UPDATE jobs SET status = ?, error = ?, finished_at = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE id = ? AND lease_owner = ?
+                """,
+                (status, error, time.time(), job_id, owner)
+            )
+
+    def defer(self, job_id: int, owner: str, delay_seconds: float):
+        """
+        Put a running job back into the queue, it is claimed again after the delay.
+        The attempt does not count, e.g. it is deferred while a backend is down.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                UPDATE jobs SET status = ?, attempts = MAX(attempts - 1, 0), not_before = ?,
+                    lease_owner = NULL, lease_expires = NULL
+                WHERE id = ? AND lease_owner = ?
+                """,
+                (STATUS_ENQUEUED, time.time() + delay_seconds, job_id, owner)
+            )
+
+    def recover(self, lease_owner_prefix: str) -> int:
+        """
+        Re-queue the running jobs left by a dead worker process, e.g. after gunicorn restarts
+        :param lease_owner_prefix: lease owner prefix of the dead process
+        :return: number of re-queued jobs
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires = NULL WHERE status = ? AND lease_owner LIKE ?",
+                (STATUS_ENQUEUED, STATUS_RUNNING, f"{lease_owner_prefix}%")
+            )
+            return cursor.rowcount
+
+    def requeue_orphans(self) -> int:
+        """
+        Re-queue the running jobs whose owner process on this host does not exist anymore
+        :return: number of re-queued jobs
+        """
+        host = socket.gethostname()
+        rows = self._connection().execute(
+            "SELECT DISTINCT lease_owner FROM jobs WHERE status = ? AND lease_owner LIKE ?",
+            (STATUS_RUNNING, f"{host}:%")
+        ).fetchall()
+        count = 0
+        for row in rows:
+            pid = int(row["lease_owner"].split(":")[1])
+            if not _pid_alive(pid):
+                count += self.recover(f"{host}:{pid}:")
+        return count
+
+    def purge(self, older_than_seconds: float) -> int:
+        """
+        Delete finished jobs older than the given age
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?, ?) AND finished_at < ?",
+                (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED, time.time() - older_than_seconds)
+            )
+            return cursor.rowcount
+
+    def get_reviewed_head(self, project_id: int, mr_id: int) -> str | None:
+        """
+        Head commit of the merge request at the last review
+        """
+        row = self._connection().execute(
+            "SELECT head_sha FROM reviewed_heads WHERE project_id = ? AND mr_id = ?", (project_id, mr_id)
+        ).fetchone()
+        return row["head_sha"] if row is not None else None
+
+    def set_reviewed_head(self, project_id: int, mr_id: int, head_sha: str):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO reviewed_heads (project_id, mr_id, head_sha, reviewed_at) VALUES (?, ?, ?, ?)",
+                (project_id, mr_id, head_sha, time.time())
+            )
+
+    def review_times(self, window_seconds: float) -> list[float]:
+        """
+        Time from the first event to the end of the review, of the jobs done in the window
+        """
+        rows = self._connection().execute(
+            "SELECT finished_at - enqueued_at AS t FROM jobs WHERE status = ? AND finished_at >= ? ORDER BY t",
+            (STATUS_DONE, time.time() - window_seconds)
+        ).fetchall()
+        return [row["t"] for row in rows]
+
+    def counts(self) -> dict:
+        """
+        Number of jobs by status
+        """
+        rows = self._connection().execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        result = {STATUS_ENQUEUED: 0, STATUS_RUNNING: 0, STATUS_DONE: 0, STATUS_FAILED: 0, STATUS_CANCELLED: 0}
+        result.update({row["status"]: row["n"] for row in rows})
+        return result
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+job_store = JobStore(review_job_db)
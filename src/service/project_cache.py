@@ -0,0 +1,101 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import requests
+
+from config.config import gitlab_metadata_ttl_seconds
+from service.gitlab_client import gitlab
+from utils.logger import log
+
+
+@dataclass
+class _Entry:
+    value: Any
+    etag: str | None
+    expires_at: float
+
+
+class MetadataCache:
+    """
+    TTL cache of GitLab metadata shared by the threads of a process.
+    An expired entry is revalidated with If-None-Match when GitLab returned an ETag for it.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries: dict[str, _Entry] = {}
+        self._hits = 0
+        self._revalidated = 0
+        self._misses = 0
+
+    def get(self, key: str, path: str, parse: Callable[[requests.Response], Any], **kwargs) -> Any:
+        """
+        Get the cached value, or fetch it from the api path
+        :param key: cache key, e.g. labels:1
+        :param path: api path to fetch the value
+        :param parse: parse the value from a 200 response
+        :param kwargs: arguments of the request
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                self._hits += 1
+                return entry.value
+
+        headers = dict(kwargs.pop("headers", {}))
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        response = gitlab.get(path, headers=headers, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            with self._lock:
+                self._revalidated += 1
+                entry.expires_at = now + self.ttl_seconds
+            return entry.value
+        if response.status_code != 200:
+            raise Exception(f"Fails to get {path}, status code: {response.status_code}")
+
+        value = parse(response)
+        with self._lock:
+            self._misses += 1
+            self._entries[key] = _Entry(value, response.headers.get("ETag"), now + self.ttl_seconds)
+        return value
+
+    def peek(self, key: str) -> Any:
+        """
+        Get the cached value without any request, even if it is expired
+        :return: None if it is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.value if entry is not None else None
+
+    def update(self, key: str, update: Callable[[Any], Any]):
+        """
+        Update the cached value in place after a write, e.g. a label is added
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.value = update(entry.value)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                log.info(f"Invalidate metadata cache: {key}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "revalidated": self._revalidated,
+                "misses": self._misses,
+            }
+
+
+metadata_cache = MetadataCache(gitlab_metadata_ttl_seconds)
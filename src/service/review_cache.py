@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from utils.logger import log
+
+
+# Line numbers of the hunk headers change on rebase, the content does not
+_HUNK_HEADER_PATTERN = re.compile(r"(?m)^@@ -\d+(?:,\d+)? \+\d+(?:,\d+)? @@")
+
+
+def normalize_diff(diff: str) -> str:
+    """
+    Normalize the diff of a file, so the same change gets the same hash after a rebase
+    """
+    diff = _HUNK_HEADER_PATTERN.sub("@@", diff)
+    return "\n".join(line.rstrip() for line in diff.splitlines())
+
+
+def hash_change(change: dict, namespace: str) -> str:
+    """
+    Cache key of the change of a file
+    :param namespace: model name and prompt version, a review is only valid for them
+    """
+    content = json.dumps({
+        "namespace": namespace,
+        "old_path": change.get("old_path"),
+        "new_path": change.get("new_path"),
+        "new_file": change.get("new_file", False),
+        "renamed_file": change.get("renamed_file", False),
+        "deleted_file": change.get("deleted_file", False),
+        "diff": normalize_diff(change.get("diff", "")),
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def hash_keys(keys: list[str], namespace: str) -> str:
+    """
+    Cache key of a set of changes, e.g. the whole merge request
+    """
+    content = namespace + "\n" + "\n".join(sorted(keys))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ReviewCache:
+    """
+    Persistent review cache keyed by content hash, with TTL and size eviction.
+    The cache is shared by all the worker processes on a host.
+    """
+
+    def __init__(self, path: Path, ttl_seconds: float, max_entries: int):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._puts = 0
+        self._connection().execute(
+            """
+            CREATE TABLE IF NOT EXISTS reviews (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS idx_reviews_accessed ON reviews (accessed_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # a connection must not be shared with the forked gunicorn workers
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT value FROM reviews WHERE key = ? AND created_at >= ?", (key, now - self.ttl_seconds)
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE reviews SET accessed_at = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            log.error(f"Read review cache failed: {e}")
+            row = None
+
+        with self._lock:
+            if row is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return row[0] if row is not None else None
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO reviews (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+        except sqlite3.Error as e:
+            log.error(f"Write review cache failed: {e}")
+            return
+
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % 100 == 1
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Delete the expired entries, then the least recently used entries above the size limit
+        """
+        conn = self._connection()
+        try:
+            expired = conn.execute(
+                "DELETE FROM reviews WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            ).rowcount
+            overflow = conn.execute(
+                """
+                DELETE FROM reviews WHERE key IN (
+                    SELECT key FROM reviews ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.max_entries,)
+            ).rowcount
+        except sqlite3.Error as e:
+            log.error(f"Evict review cache failed: {e}")
+            return 0
+        if expired or overflow:
+            log.info(f"Evict review cache: {expired} expired, {overflow} over the size limit")
+        return expired + overflow
+
+    def stats(self) -> dict:
+        """
+        Get the cache statistics, hits and misses are of the current process
+        """
+        try:
+            entries = self._connection().execute("SELECT COUNT(*) FROM reviews").fetchone()[0]
+        except sqlite3.Error:
+            entries = -1
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,326 @@
+import os
+import threading
+import time
+from functools import partial
+
+from config.config import (
+    review_aging_tokens_per_minute,
+    review_default_cost_tokens,
+    review_job_retention_seconds,
+    review_lease_seconds,
+    review_max_attempts,
+    review_debounce_seconds,
+    review_priority_boost_tokens,
+    review_queue_size,
+    review_retry_budget,
+    review_retry_budget_seconds,
+    review_workers
+)
+from service.chat_review import ReviewCancelled, estimate_review_cost, llm_breaker, prepare_review, review_code_for_mr
+from service.gitlab_api import get_user_id, set_label_failed
+from service.job_store import COALESCED, DUPLICATE, FULL, Job, JobStore, job_store
+from utils.logger import log
+from utils.metrics import REVIEW_DURATION, REVIEW_OUTCOMES
+from utils.resilience import CircuitOpenError, retry_budget
+from utils.tracing import record_span, span, trace
+
+
+# Interval to look for jobs enqueued by other processes
+POLL_INTERVAL_SECONDS = 2
+# A job is estimated again if the process estimating it dies
+ESTIMATE_RETRY_SECONDS = 60
+# Interval to fetch the bot user id again if GitLab is not reachable
+USER_ID_RETRY_SECONDS = 30
+# Window of the time to review statistics
+TIME_TO_REVIEW_WINDOW_SECONDS = 24 * 3600
+
+
+class ReviewQueue:
+    """
+    Bounded queue of merge request reviews, consumed by a fixed pool of review workers in each process.
+    Jobs are persisted in the job store, so the reviews are resumed after the workers restart.
+    The cost of a job is estimated while it waits, and the cheapest job goes first to keep
+    the median time to review low, with aging and priority boosts taken into account.
+    """
+
+    def __init__(self, store: JobStore, max_size: int, workers: int):
+        self.store = store
+        self.max_size = max_size
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._held: dict[int, str] = {}
+        self._submitted = 0
+        self._rejected = 0
+        self._coalesced = 0
+        self._cancelled = 0
+        self._deferred = 0
+        self._succeeded = 0
+        self._failed = 0
+        self._started = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_last = 0.0
+
+    def start(self):
+        """
+        Start the workers in the current process.
+        gunicorn preloads the app in the master process, so the workers must not be started on import.
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+        requeued = self.store.requeue_orphans()
+        if requeued:
+            log.warning(f"Re-queue {requeued} review jobs left by dead workers")
+        self.store.purge(review_job_retention_seconds)
+
+        threading.Thread(target=self._fetch_user_id, name="review-user-id", daemon=True).start()
+        threading.Thread(target=self._keep_leases, name="review-lease", daemon=True).start()
+        threading.Thread(target=self._estimate, name="review-estimator", daemon=True).start()
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f"review-worker-{i}", daemon=True).start()
+
+    def submit(self, project_id: int, mr_id: int, payload: dict, head_sha: str | None = None,
+               priority: int = 0, trace_id: str | None = None) -> bool:
+        """
+        Put a review into the queue, it starts after a quiet window without newer events of the merge request
+        :param priority: number of priority boosts of the review
+        :param trace_id: trace of the webhook, the review continues it
+        :return: False if the queue is full
+        """
+        self.start()
+        job_id, result = self.store.enqueue(
+            project_id, mr_id, payload, head_sha=head_sha,
+            delay_seconds=review_debounce_seconds, max_pending=self.max_size, priority=priority, trace_id=trace_id
+        )
+        if result == FULL:
+            with self._lock:
+                self._rejected += 1
+            log.warning("Review queue is full (%s), reject mr: %s!%s", self.max_size, project_id, mr_id)
+            return False
+
+        with self._lock:
+            self._submitted += 1
+            if result in (COALESCED, DUPLICATE):
+                self._coalesced += 1
+        if result != DUPLICATE:
+            log.info("Review job %s of mr: %s!%s %s", job_id, project_id, mr_id, result)
+        return True
+
+    def cancel(self, project_id: int, mr_id: int):
+        """
+        Cancel the pending and running reviews of the merge request
+        """
+        cancelled = self.store.cancel(project_id, mr_id)
+        if cancelled:
+            log.info("Cancel %s review jobs of mr: %s!%s", cancelled, project_id, mr_id)
+
+    def _work(self):
+        owner = JobStore.owner_id()
+        while True:
+            try:
+                job = self.store.claim(
+                    owner, review_lease_seconds,
+                    default_cost=review_default_cost_tokens,
+                    aging_per_second=review_aging_tokens_per_minute / 60,
+                    priority_boost=review_priority_boost_tokens
+                )
+            except Exception as e:
+                log.error(f"Claim review job failed: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(POLL_INTERVAL_SECONDS)
+                self._wakeup.clear()
+                continue
+
+            with self._lock:
+                self._held[job.id] = owner
+            try:
+                with trace("review", trace_id=job.trace_id, project_id=job.project_id, mr_id=job.mr_id,
+                           job_id=job.id, attempt=job.attempts) as root:
+                    # the wall clock times of the queue are shared by the processes
+                    now, offset = time.time(), time.monotonic()
+                    record_span("queue.wait", offset - (now - job.enqueued_at), offset - (now - job.started_at))
+                    root.attributes["outcome"] = self._run(job, owner)
+            finally:
+                with self._lock:
+                    # the job may be claimed again by another worker after the lease is lost
+                    if self._held.get(job.id) == owner:
+                        del self._held[job.id]
+
+    def _run(self, job: Job, owner: str) -> str:
+        """
+        :return: outcome of the review, succeeded, skipped, cancelled, deferred or failed
+        """
+        wait = job.started_at - job.enqueued_at
+        with self._lock:
+            self._started += 1
+            self._wait_total += wait
+            self._wait_last = wait
+            self._wait_max = max(self._wait_max, wait)
+
+        if job.attempts > review_max_attempts:
+            self._fail(job, owner, f"Review job is claimed {job.attempts} times, give up")
+            return "failed"
+
+        log.info(f"Start review mr: {job.project_id}!{job.mr_id} (job {job.id}, attempt {job.attempts}), "
+                 f"waited {wait:.1f}s in queue, cost: {job.cost} tokens, priority: {job.priority}")
+        start, outcome = time.monotonic(), "succeeded"
+        try:
+            if self.store.is_cancelled(job.id):
+                raise ReviewCancelled(f"Review job {job.id} is cancelled before it starts")
+            if not llm_breaker.available:
+                raise CircuitOpenError(f"Circuit of {llm_breaker.name} is open, the LLM is down",
+                                       llm_breaker.retry_after)
+            # the gitlab and LLM calls of the review share one retry budget,
+            # a review stops at once if gitlab or the LLM is known to be down
+            with retry_budget(review_retry_budget, review_retry_budget_seconds):
+                with span("prepare"):
+                    prepared = prepare_review(job.project_id, job.mr_id, job.payload)
+                if not prepared:
+                    log.info(f"Skip mr: {job.project_id}!{job.mr_id} (job {job.id}), the bot is not a reviewer")
+                    REVIEW_OUTCOMES.labels("skipped").inc()
+                    outcome = "skipped"
+                else:
+                    review_code_for_mr(
+                        job.project_id, job.mr_id, job.payload, is_cancelled=partial(self._is_cancelled, job, owner)
+                    )
+        except ReviewCancelled as e:
+            log.info(str(e))
+            REVIEW_DURATION.labels("cancelled").observe(time.monotonic() - start)
+            self.store.finish(job.id, owner, cancelled=True)
+            with self._lock:
+                self._cancelled += 1
+            return "cancelled"
+        except Exception as e:
+            if isinstance(e, CircuitOpenError) or not llm_breaker.available:
+                # the backend is down, the review is not failed but waits for the circuit to let a probe through
+                retry_after = e.retry_after if isinstance(e, CircuitOpenError) else llm_breaker.retry_after
+                self._defer(job, owner, max(retry_after, POLL_INTERVAL_SECONDS), str(e))
+                return "deferred"
+            REVIEW_DURATION.labels("failed").observe(time.monotonic() - start)
+            self._fail(job, owner, str(e))
+            return "failed"
+
+        REVIEW_DURATION.labels(outcome).observe(time.monotonic() - start)
+        self.store.finish(job.id, owner)
+        with self._lock:
+            self._succeeded += 1
+        return outcome
+
+    def _is_cancelled(self, job: Job, owner: str) -> bool:
+        """
+        Whether the running job must stop: it is cancelled, or its lease is lost and another worker may run it
+        """
+        with self._lock:
+            if self._held.get(job.id) != owner:
+                return True
+        return self.store.is_cancelled(job.id)
+
+    def _defer(self, job: Job, owner: str, delay: float, error: str):
+        log.warning(f"Defer review mr: {job.project_id}!{job.mr_id} (job {job.id}) for {delay:.0f}s: {error}")
+        self.store.defer(job.id, owner, delay)
+        with self._lock:
+            self._deferred += 1
+
+    def _fail(self, job: Job, owner: str, error: str):
+        log.error(f"Review mr: {job.project_id}!{job.mr_id} (job {job.id}) failed: {error}")
+        self.store.finish(job.id, owner, error=error)
+        with self._lock:
+            self._failed += 1
+        try:
+            set_label_failed(job.project_id, job.mr_id)
+        except Exception as label_error:
+            log.error(f"Set failed label for mr: {job.project_id}!{job.mr_id} failed: {label_error}")
+
+    def _estimate(self):
+        """
+        Estimate the cost of the waiting jobs by their diffs, a job that is not estimated yet has the default cost
+        """
+        while True:
+            try:
+                job = self.store.claim_estimate(ESTIMATE_RETRY_SECONDS)
+            except Exception as e:
+                log.error(f"Claim review job to estimate failed: {e}")
+                job = None
+            if job is None:
+                time.sleep(POLL_INTERVAL_SECONDS)
+                continue
+            try:
+                cost = estimate_review_cost(job.project_id, job.mr_id)
+                self.store.set_cost(job.id, job.head_sha, cost)
+            except Exception as e:
+                log.warning(f"Estimate review job {job.id} failed: {e}")
+                continue
+            log.info(f"Review job {job.id} of mr: {job.project_id}!{job.mr_id} costs about {cost} tokens")
+
+    @staticmethod
+    def _fetch_user_id():
+        """
+        Fetch the bot user id in the background, so the webhook filters the events by the reviewers without a request
+        """
+        while True:
+            try:
+                get_user_id()
+                return
+            except Exception:
+                time.sleep(USER_ID_RETRY_SECONDS)
+
+    def _keep_leases(self):
+        while True:
+            time.sleep(review_lease_seconds / 3)
+            with self._lock:
+                held = list(self._held.items())
+            for job_id, owner in held:
+                try:
+                    if not self.store.renew(job_id, owner, review_lease_seconds):
+                        # the review stops at its next cancellation check
+                        log.warning(f"Lease of review job {job_id} is lost, stop its review")
+                        with self._lock:
+                            if self._held.get(job_id) == owner:
+                                del self._held[job_id]
+                except Exception as e:
+                    log.error(f"Renew lease of review job {job_id} failed: {e}")
+
+    def stats(self) -> dict:
+        """
+        Get the queue statistics, depth is shared by all the processes, others are of the current process
+        """
+        counts = self.store.counts()
+        times = self.store.review_times(TIME_TO_REVIEW_WINDOW_SECONDS)
+
+        def percentile(p: float) -> float:
+            return round(times[min(len(times) - 1, int(len(times) * p))], 3) if times else 0.0
+
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "workers": self.workers,
+                "max_size": self.max_size,
+                "depth": counts["enqueued"],
+                "running": counts["running"],
+                "jobs": counts,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "coalesced": self._coalesced,
+                "cancelled": self._cancelled,
+                "deferred": self._deferred,
+                "succeeded": self._succeeded,
+                "failed": self._failed,
+                "wait_avg_seconds": round(self._wait_total / self._started, 3) if self._started else 0.0,
+                "wait_max_seconds": round(self._wait_max, 3),
+                "wait_last_seconds": round(self._wait_last, 3),
+                # of all the processes, in the last day
+                "time_to_review": {
+                    "count": len(times),
+                    "p50_seconds": percentile(0.5),
+                    "p90_seconds": percentile(0.9),
+                },
+            }
+
+
+review_queue = ReviewQueue(job_store, review_queue_size, review_workers)
@@ -0,0 +1,67 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent.parent
+SRC_ROOT = ROOT / 'src'
+
+sys.path.append(ROOT.as_posix())
+sys.path.append(SRC_ROOT.as_posix())
+
+
+import pytest
+
+from service import chat_review
+from service.review_cache import ReviewCache
+from service.token_budget import HeuristicTokenizer, TokenBudget
+
+
+def change(path: str, line: str) -> dict:
+    return {"old_path": path, "new_path": path, "diff": f"@@ -1 +1 @@\n-old\n+{line}\n"}
+
+
+@pytest.fixture
+def reviews(monkeypatch, tmp_path):
+    """
+    Review each chunk by its changed lines, the reduce step joins the reviews
+    """
+    calls = []
+
+    def review(chunk, discussion=""):
+        calls.append([item["new_path"] for item in chunk])
+        return " ".join(item["diff"].rsplit("+", 1)[1].strip() for item in chunk)
+
+    monkeypatch.setattr(chat_review, "review_cache", ReviewCache(tmp_path / "cache.sqlite3", 3600, 100))
+    monkeypatch.setattr(chat_review, "generate_review_note", review)
+    monkeypatch.setattr(chat_review, "generate_reduce_note", lambda notes: " | ".join(sorted(notes)))
+    return calls
+
+
+def test_chunk_review_is_not_reused_when_a_file_of_it_changes(reviews):
+    assert chat_review.map_reduce_review([change("a.py", "a1"), change("b.py", "b1")]) == "a1 b1"
+    assert reviews == [["a.py", "b.py"]]
+
+    # a.py is unchanged, but its review is the review of the chunk with b1 in it
+    note = chat_review.map_reduce_review([change("a.py", "a1"), change("b.py", "b2")])
+    assert "b1" not in note
+    assert sorted(reviews[1]) == ["a.py", "b.py"]
+
+    # nothing changed, the review of the chunk is reused
+    assert chat_review.map_reduce_review([change("a.py", "a1"), change("b.py", "b2")]) == note
+    assert len(reviews) == 2
+
+
+def test_reduce_merges_in_batches_within_the_budget(monkeypatch):
+    budget = TokenBudget(HeuristicTokenizer(), 400, 0, [chat_review.REDUCE_PROMPT])
+    prompts = []
+
+    def merge(messages):
+        prompts.append(messages[1]["content"])
+        return f"merged {len(prompts)}"
+
+    monkeypatch.setattr(chat_review, "create_token_budget", lambda *args: budget)
+    monkeypatch.setattr(chat_review, "generate_llm_note", merge)
+
+    note = chat_review.generate_reduce_note([f"review {i} " + "x" * 300 for i in range(10)])
+    assert note == f"merged {len(prompts)}"
+    assert len(prompts) > 1
+    assert all(budget.tokenizer.count(prompt) <= budget.num_ctx for prompt in prompts)
@@ -0,0 +1,25 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent.parent
+SRC_ROOT = ROOT / 'src'
+
+sys.path.append(SRC_ROOT.as_posix())
+
+
+from service.content_handle import is_whitespace_only
+
+
+def test_whitespace_only_indentation():
+    assert is_whitespace_only("@@ -1,2 +1,2 @@\n-  a = 1\n-b = 2\n+    a = 1\n+b = 2  \n")
+    assert is_whitespace_only("@@ -1,1 +1,2 @@\n-a = 1\n+a = 1\n+\n")
+
+
+def test_whitespace_in_string_literal():
+    assert not is_whitespace_only('@@ -1 +1 @@\n-s = "a  b"\n+s = "a b"\n')
+    assert not is_whitespace_only('@@ -1 +1 @@\n-s = "a  b"\n+s = "a b"\n', keep_indent=True)
+
+
+def test_indentation_sensitive():
+    assert not is_whitespace_only("@@ -1 +1 @@\n-    return a\n+        return a\n", keep_indent=True)
+    assert is_whitespace_only("@@ -1 +1 @@\n-    return a\n+    return a  \n", keep_indent=True)
@@ -0,0 +1,28 @@
+import sys
+from http.client import RemoteDisconnected
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent.parent
+SRC_ROOT = ROOT / 'src'
+
+sys.path.append(ROOT.as_posix())
+sys.path.append(SRC_ROOT.as_posix())
+
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+
+from service.gitlab_client import is_retryable
+
+
+def test_post_is_retried_if_not_sent():
+    refused = requests.ConnectionError(MaxRetryError(None, "/notes", NewConnectionError(None, "refused")))
+    assert is_retryable("POST", refused)
+    assert is_retryable("POST", requests.ConnectTimeout())
+
+
+def test_post_is_not_retried_if_the_connection_is_closed_after_sending():
+    aborted = requests.ConnectionError(ProtocolError("Connection aborted.", RemoteDisconnected("closed")))
+    assert not is_retryable("POST", aborted)
+    assert not is_retryable("POST", requests.ReadTimeout())
+    assert is_retryable("GET", aborted)
@@ -0,0 +1,143 @@
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent.parent
+SRC_ROOT = ROOT / 'src'
+
+sys.path.append(ROOT.as_posix())
+sys.path.append(SRC_ROOT.as_posix())
+
+
+import pytest
+
+from service.job_store import (
+    COALESCED,
+    DUPLICATE,
+    ENQUEUED,
+    FULL,
+    STATUS_CANCELLED,
+    STATUS_DONE,
+    STATUS_ENQUEUED,
+    STATUS_FAILED,
+    JobStore
+)
+
+
+@pytest.fixture
+def store(tmp_path) -> JobStore:
+    return JobStore(tmp_path / "jobs.sqlite3")
+
+
+def test_enqueue_and_claim(store):
+    job_id, result = store.enqueue(1, 2, {"mr": 2}, head_sha="a")
+    assert result == ENQUEUED
+    job = store.claim("worker", 60)
+    assert (job.id, job.payload, job.head_sha, job.attempts) == (job_id, {"mr": 2}, "a", 1)
+    assert store.claim("worker", 60) is None
+
+    store.finish(job.id, "worker")
+    assert store.counts()[STATUS_DONE] == 1
+
+
+def test_queue_is_full(store):
+    store.enqueue(1, 1, {}, max_pending=2)
+    store.enqueue(1, 2, {}, max_pending=2)
+    assert store.enqueue(1, 3, {}, max_pending=2) == (None, FULL)
+
+
+def test_quiet_window(store):
+    store.enqueue(1, 2, {}, delay_seconds=60)
+    assert store.claim("worker", 60) is None
+
+
+def test_expired_lease_is_claimed_again(store):
+    job_id, _ = store.enqueue(1, 2, {})
+    store.claim("dead", 0.01)
+    time.sleep(0.02)
+    job = store.claim("worker", 60)
+    assert (job.id, job.attempts) == (job_id, 2)
+
+    # the lost lease can not be renewed, nor finish the job
+    assert not store.renew(job_id, "dead", 60)
+    store.finish(job_id, "dead", error="stale")
+    assert store.counts()[STATUS_FAILED] == 0
+
+
+
+def test_events_are_coalesced(store):
+    job_id, _ = store.enqueue(1, 2, {"v": 1}, head_sha="a")
+    assert store.enqueue(1, 2, {"v": 2}, head_sha="b") == (job_id, COALESCED)
+    job = store.claim("worker", 60)
+    assert (job.id, job.payload, job.head_sha) == (job_id, {"v": 2}, "b")
+
+
+def test_running_review_of_the_same_head_is_a_duplicate(store):
+    job_id, _ = store.enqueue(1, 2, {}, head_sha="a")
+    store.claim("worker", 60)
+    assert store.enqueue(1, 2, {}, head_sha="a") == (job_id, DUPLICATE)
+    assert not store.is_cancelled(job_id)
+
+
+def test_running_review_is_superseded_by_a_new_head(store):
+    old_id, _ = store.enqueue(1, 2, {}, head_sha="a")
+    store.claim("worker", 60)
+    new_id, result = store.enqueue(1, 2, {}, head_sha="b")
+    assert result == ENQUEUED and new_id != old_id
+    assert store.is_cancelled(old_id)
+    assert not store.is_cancelled(new_id)
+
+
+def test_cancel(store):
+    running_id, _ = store.enqueue(1, 2, {}, head_sha="a")
+    store.claim("worker", 60)
+    store.enqueue(1, 2, {}, head_sha="b")
+    assert store.cancel(1, 2) == 2
+    assert store.is_cancelled(running_id)
+    assert store.counts()[STATUS_CANCELLED] == 1
+    assert store.claim("worker", 60) is None
+
+
+def test_cheapest_job_is_claimed_first(store):
+    large, _ = store.enqueue(1, 1, {}, head_sha="a")
+    small, _ = store.enqueue(1, 2, {}, head_sha="b")
+    unknown, _ = store.enqueue(1, 3, {}, head_sha="c")
+    store.set_cost(large, "a", 50000)
+    store.set_cost(small, "b", 1000)
+    claimed = [store.claim("worker", 60, default_cost=8000).id for _ in range(3)]
+    assert claimed == [small, unknown, large]
+
+
+def test_aging_and_priority(store):
+    old, _ = store.enqueue(1, 1, {}, head_sha="a")
+    store.set_cost(old, "a", 50000)
+    time.sleep(0.05)
+    new, _ = store.enqueue(1, 2, {}, head_sha="b")
+    store.set_cost(new, "b", 1000)
+    # the old job gains 1000000 tokens of priority per second in queue
+    assert store.claim("worker", 60, aging_per_second=1000000).id == old
+
+    boosted, _ = store.enqueue(1, 3, {}, head_sha="c", priority=1)
+    store.set_cost(boosted, "c", 20000)
+    assert store.claim("worker", 60, priority_boost=20000).id == boosted
+
+
+def test_cost_of_a_coalesced_job_is_estimated_again(store):
+    job_id, _ = store.enqueue(1, 2, {}, head_sha="a")
+    estimating = store.claim_estimate(60)
+    store.enqueue(1, 2, {}, head_sha="b")
+    store.set_cost(job_id, estimating.head_sha, 1000)
+    assert store.claim_estimate(60).head_sha == "b"
+
+
+def test_deferred_job_waits_and_keeps_its_attempts(store):
+    store.enqueue(1, 2, {})
+    job = store.claim("worker", 60)
+    store.defer(job.id, "worker", 60)
+    assert store.counts()[STATUS_ENQUEUED] == 1
+    assert store.claim("worker", 60) is None
+
+    store.enqueue(1, 3, {})
+    job = store.claim("worker", 60)
+    store.defer(job.id, "worker", 0)
+    assert store.claim("worker", 60).attempts == 1
@@ -0,0 +1,55 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent.parent
+SRC_ROOT = ROOT / 'src'
+
+sys.path.append(SRC_ROOT.as_posix())
+
+
+from service.token_budget import HeuristicTokenizer, TokenBudget
+
+
+def change(path: str, lines: int) -> dict:
+    diff = "".join(f"@@ -{i} +{i} @@\n+{'x' * 60}\n" for i in range(lines))
+    return {"new_path": path, "diff": diff}
+
+
+def budget(num_ctx: int = 1000) -> TokenBudget:
+    return TokenBudget(HeuristicTokenizer(), num_ctx, 0, [""])
+
+
+def test_changes_are_packed_within_the_budget():
+    tokens = budget()
+    changes = [change(f"{i}.py", 3) for i in range(10)]
+    batches = list(tokens.pack_stream(changes))
+    assert sorted(item["new_path"] for batch in batches for item in batch) == sorted(c["new_path"] for c in changes)
+    assert len(batches) < len(changes)
+    assert all(tokens.count_changes(batch) <= tokens.available for batch in batches)
+
+
+def test_files_keep_their_order_in_a_batch():
+    batches = list(budget().pack_stream([change("a.py", 1), change("b.py", 1), change("c.py", 1)]))
+    assert [[item["new_path"] for item in batch] for batch in batches] == [["a.py", "b.py", "c.py"]]
+
+
+def test_large_change_is_split_by_hunks():
+    tokens = budget()
+    batches = list(tokens.pack_stream([change("large.py", 40)]))
+    assert len(batches) > 1
+    assert all(item["new_path"] == "large.py" for batch in batches for item in batch)
+    assert all(tokens.count_changes(batch) <= tokens.available for batch in batches)
+
+
+def test_batches_are_streamed_before_the_last_change():
+    tokens = budget()
+    consumed = []
+
+    def changes():
+        for i in range(20):
+            consumed.append(i)
+            yield change(f"{i}.py", 3)
+
+    stream = tokens.pack_stream(changes(), max_open=2)
+    next(stream)
+    assert len(consumed) < 20
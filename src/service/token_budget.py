@@ -0,0 +1,202 @@
+import importlib
+import json
+import re
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator
+
+from utils.logger import log
+
+
+# Marker appended to a hunk which is truncated to fit the budget
+TRUNCATED_MARKER = "\n... (truncated)\n"
+
+# Tokens of the chat template around each message
+MESSAGE_OVERHEAD_TOKENS = 8
+
+# A streamed batch is sent once it is filled to this ratio of the budget
+STREAM_FULL_RATIO = 0.9
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+class Tokenizer(ABC):
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        """Count the tokens of the text"""
+        pass
+
+
+class HeuristicTokenizer(Tokenizer):
+    """
+    Fast token estimation without a vocabulary:
+    a CJK character is about one token, other text is about 3 characters per token for code
+    """
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        cjk = len(_CJK_PATTERN.findall(text))
+        return cjk + (len(text) - cjk + 2) // 3
+
+
+class TiktokenTokenizer(Tokenizer):
+    """
+    Token count by tiktoken, it is close enough for most open models
+    """
+
+    def __init__(self, encoding: str = "cl100k_base"):
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+def load_tokenizer(impl: str) -> Tokenizer:
+    """
+    Load the tokenizer by class path, fall back to the heuristic tokenizer if it is not available
+    """
+    try:
+        module_name, class_name = impl.rsplit('.', 1)
+        module = importlib.import_module(module_name)
+        return getattr(module, class_name)()
+    except Exception as e:
+        log.warning(f"Tokenizer {impl} is not available, use the heuristic tokenizer: {e}")
+        return HeuristicTokenizer()
+
+
+class TokenBudget:
+    """
+    Token budget of a review request: the context window minus the output headroom and the fixed prompt.
+    Changed files are packed into as few requests as possible within the budget.
+    """
+
+    def __init__(self, tokenizer: Tokenizer, num_ctx: int, output_reserve: int, prompt_messages: list[str]):
+        self.tokenizer = tokenizer
+        self.num_ctx = num_ctx
+        self.output_reserve = output_reserve
+        self.prompt_tokens = sum(tokenizer.count(message) + MESSAGE_OVERHEAD_TOKENS for message in prompt_messages)
+        self.available = num_ctx - output_reserve - self.prompt_tokens
+        if self.available <= 0:
+            raise ValueError(f"No token budget for the diff: num_ctx {num_ctx}, "
+                             f"output reserve {output_reserve}, prompt {self.prompt_tokens}")
+
+    def count_change(self, change: dict) -> int:
+        return self.tokenizer.count(json.dumps(change, ensure_ascii=False))
+
+    def count_changes(self, changes: list[dict]) -> int:
+        return self.tokenizer.count(json.dumps(changes, ensure_ascii=False))
+
+    def _count_encoded(self, text: str) -> int:
+        # the quotes are counted with each piece, so the sum of the pieces is not less than the count of the whole
+        return self.tokenizer.count(json.dumps(text, ensure_ascii=False))
+
+    def split_change(self, change: dict) -> tuple[list[dict], int]:
+        """
+        Split the diff of a file into parts by hunks, each part fits the budget.
+        A hunk which is larger than the budget is truncated.
+        :return: parts, number of truncated hunks
+        """
+        # 2 tokens for the separator of the json list, as in pack_stream
+        overhead = self.count_change({**change, "diff": ""}) + 2
+        limit = self.available - overhead
+        hunks = re.split(r"(?m)^(?=@@)", change.get("diff", ""))
+
+        parts, current, current_tokens, truncated = [], "", 0, 0
+        for hunk in hunks:
+            # the diff is sent json encoded
+            tokens = self._count_encoded(hunk)
+            if tokens > limit:
+                # keep the head of the hunk, the ratio is estimated by the characters
+                hunk = hunk[:max(0, len(hunk) * limit // tokens - len(TRUNCATED_MARKER))] + TRUNCATED_MARKER
+                tokens = self._count_encoded(hunk)
+                truncated += 1
+            if current and current_tokens + tokens > limit:
+                parts.append(current)
+                current, current_tokens = "", 0
+            current += hunk
+            current_tokens += tokens
+        if current:
+            parts.append(current)
+        return [{**change, "diff": part} for part in parts], truncated
+
+    def batch_texts(self, texts: list[str], overhead: int = 0) -> list[list[str]]:
+        """
+        Batch the texts in their order, each batch fits the budget.
+        A text is truncated to half of the budget, so a batch of several texts has at least two of them,
+        and merging the batches again and again ends with one batch.
+        :param overhead: tokens around each text in the prompt, e.g. its header
+        """
+        limit = self.available // 2 - overhead
+        batches, current, load = [], [], 0
+        for text in texts:
+            tokens = self.tokenizer.count(text)
+            if tokens > limit:
+                # keep the head of the text, the ratio is estimated by the characters
+                text = text[:max(0, len(text) * limit // tokens - len(TRUNCATED_MARKER))] + TRUNCATED_MARKER
+                tokens = self.tokenizer.count(text)
+            tokens += overhead
+            if current and load + tokens > self.available:
+                batches.append(current)
+                current, load = [], 0
+            current.append(text)
+            load += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    def _items(self, index: int, change: dict) -> tuple[list[tuple], bool, int]:
+        """
+        Items to pack of a change, a change larger than the budget is split
+        :return: items of ((index, part number), change, tokens), whether it is split, number of truncated hunks
+        """
+        tokens = self.count_change(change)
+        if tokens <= self.available:
+            return [((index, 0), change, tokens)], False, 0
+        parts, truncated = self.split_change(change)
+        return [((index, i), part, self.count_change(part)) for i, part in enumerate(parts)], True, truncated
+
+    def pack_stream(self, changes: Iterable[dict], max_open: int = 4) -> Iterator[list[dict]]:
+        """
+        Pack the changes into batches while they arrive, so a batch is reviewed before the last change is fetched.
+        First-fit into at most max_open batches, a batch is emitted when it is nearly full,
+        or the fullest one is emitted when a change fits none of them.
+        """
+        bins: list[list] = []
+        loads: list[int] = []
+        emitted, total_tokens, files, split_files, truncated_hunks = [], 0, 0, 0, 0
+
+        def emit(i: int) -> list[dict]:
+            emitted.append(loads.pop(i))
+            return [item[1] for item in sorted(bins.pop(i), key=lambda x: x[0])]
+
+        for index, change in enumerate(changes):
+            files += 1
+            items, split, truncated = self._items(index, change)
+            split_files += int(split)
+            truncated_hunks += truncated
+            for item in items:
+                # 2 tokens for the separator of the json list
+                tokens = item[2] + 2
+                total_tokens += tokens
+                target = next((i for i, load in enumerate(loads) if load + tokens <= self.available), None)
+                if target is None:
+                    if len(bins) >= max_open:
+                        yield emit(loads.index(max(loads)))
+                    bins.append([])
+                    loads.append(0)
+                    target = len(bins) - 1
+                bins[target].append(item)
+                loads[target] += tokens
+                if loads[target] >= self.available * STREAM_FULL_RATIO:
+                    yield emit(target)
+
+        while bins:
+            yield emit(0)
+        log.info(
+            f"Token budget: num_ctx {self.num_ctx}, output reserve {self.output_reserve}, "
+            f"prompt {self.prompt_tokens}, available {self.available} | "
+            f"{files} files, {total_tokens} tokens -> {len(emitted)} streamed requests {emitted}, "
+            f"split {split_files} files, truncated {truncated_hunks} hunks"
+        )
@@ -0,0 +1,108 @@
+import math
+import re
+from dataclasses import dataclass
+from typing import Callable
+
+from utils.logger import log
+
+
+# Paths where a bug is expensive
+_RISKY_PATH_PATTERN = re.compile(
+    r"(^|/)(auth\w*|security|crypto\w*|permissions?|acl|migrations?|payments?|billing|secrets?|"
+    r"settings|config|\.github/workflows|\.gitlab-ci\.yml|Dockerfile|docker-compose[^/]*)(/|$|\.)",
+    re.IGNORECASE
+)
+_TEST_PATH_PATTERN = re.compile(r"(^|/)(tests?|spec|__tests__)/|(_test|\.test|\.spec|_spec)\.\w+$|(^|/)test_[^/]+$")
+_DOC_PATH_PATTERN = re.compile(r"(^|/)docs?/|\.(md|rst|txt|adoc)$|(^|/)(LICENSE|CHANGELOG)[^/]*$", re.IGNORECASE)
+_SOURCE_SUFFIXES = (
+    ".py", ".go", ".java", ".kt", ".scala", ".js", ".jsx", ".ts", ".tsx", ".vue", ".c", ".cc", ".cpp", ".h",
+    ".hpp", ".rs", ".rb", ".php", ".cs", ".swift", ".m", ".sql", ".sh",
+)
+_CONFIG_SUFFIXES = (".yml", ".yaml", ".json", ".toml", ".ini", ".conf", ".xml", ".properties", ".env")
+
+RISKY_PATH_SCORE = 10
+SOURCE_SCORE = 3
+CONFIG_SCORE = 1
+TEST_SCORE = -5
+DOC_SCORE = -8
+DELETED_SCORE = -3
+
+
+def churn(change: dict) -> int:
+    """
+    Number of added and removed lines
+    """
+    return sum(
+        1 for line in (change.get("diff") or "").splitlines()
+        if line[:1] in ("+", "-")
+    )
+
+
+def risk_score(change: dict) -> float:
+    """
+    Cheap risk score of a changed file by its path, type and churn, a higher score is reviewed first
+    """
+    path = change.get("new_path") or change.get("old_path") or ""
+    score = math.log2(1 + churn(change))
+    if _RISKY_PATH_PATTERN.search(path):
+        score += RISKY_PATH_SCORE
+    if _DOC_PATH_PATTERN.search(path):
+        score += DOC_SCORE
+    elif _TEST_PATH_PATTERN.search(path):
+        score += TEST_SCORE
+    elif path.endswith(_SOURCE_SUFFIXES):
+        score += SOURCE_SCORE
+    elif path.endswith(_CONFIG_SUFFIXES):
+        score += CONFIG_SCORE
+    if change.get("deleted_file"):
+        score += DELETED_SCORE
+    return score
+
+
+@dataclass
+class TriageResult:
+    covered: list[dict]
+    skipped: list[dict]
+    tokens: int
+
+    def note(self) -> str:
+        """
+        Coverage note posted with the partial review
+        """
+        def paths(changes: list[dict]) -> str:
+            return "\n".join(f"- `{change.get('new_path') or change.get('old_path')}`" for change in changes)
+
+        total = len(self.covered) + len(self.skipped)
+        return (
+            f"> ⚠️ 大型合并请求: 共 {total} 个文件，按风险审核了 {len(self.covered)} 个文件，"
+            f"跳过了 {len(self.skipped)} 个文件\n\n"
+            f"<details><summary>已审核的文件 ({len(self.covered)})</summary>\n\n{paths(self.covered)}\n\n</details>\n\n"
+            f"<details><summary>未审核的文件 ({len(self.skipped)})</summary>\n\n{paths(self.skipped)}\n\n</details>"
+        )
+
+
+def triage(changes: list[dict], max_files: int, max_tokens: int, count: Callable[[str], int]) -> TriageResult:
+    """
+    Pick the riskiest files of an oversized merge request, within the number of files and the token budget.
+    A file that does not fit is skipped, and a smaller one below it may still be covered.
+    The riskiest file is always covered.
+    :param max_files: maximum number of files to review
+    :param max_tokens: token budget of the diffs to review
+    :param count: count the tokens of a text
+    """
+    ranked = sorted(changes, key=risk_score, reverse=True)
+    covered, skipped, tokens = [], [], 0
+    for change in ranked:
+        change_tokens = count(change.get("diff") or "")
+        if covered and (len(covered) >= max_files or tokens + change_tokens > max_tokens):
+            skipped.append(change)
+            continue
+        covered.append(change)
+        tokens += change_tokens
+
+    # the files keep the order of the merge request in the review
+    order = {id(change): index for index, change in enumerate(changes)}
+    covered.sort(key=lambda change: order[id(change)])
+    skipped.sort(key=lambda change: order[id(change)])
+    log.info(f"Triage: review {len(covered)} of {len(changes)} files, {tokens} tokens, budget {max_tokens}")
+    return TriageResult(covered, skipped, tokens)
@@ -1,7 +1,11 @@
+import atexit
+import json
 import os
 import logging
+import queue
+import threading
 from pathlib import Path
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 
 # 日志级别
 CRITICAL = 50
@@ -18,19 +22,115 @@ PROJECT_ROOT = Path(__file__).parent.parent.parent
 LOG_PATH = PROJECT_ROOT / 'logs'
 
 
+LOG_LINE_FORMAT = '%(asctime)s.%(msecs)03d %(levelname)s | [%(threadName)s] %(name)s [%(lineno)d] | %(filename)s %(funcName)s | %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# 日志中的请求内容、prompt等大对象最多输出的字符数
+MAX_DUMP_CHARS = int(os.environ.get('LOG_MAX_DUMP_CHARS', '2000'))
+
+
 if not os.path.exists(LOG_PATH):
     os.makedirs(LOG_PATH)
 
+
+class Truncated:
+    """
+    截断过长的日志参数，只在日志真正输出时才转为字符串，例如 log.debug("payload: %s", Truncated(payload))
+    """
+
+    def __init__(self, value, limit: int = MAX_DUMP_CHARS):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = str(self.value)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... ({len(text)} chars)"
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出为一行JSON，便于日志系统采集
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": f"{self.formatTime(record, LOG_DATE_FORMAT)}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "file": record.filename,
+            "line": record.lineno,
+            "func": record.funcName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    日志记录放入队列后立即返回，由后台线程格式化并写入控制台和文件。
+    gunicorn 预加载应用后 fork 出的 worker 没有后台线程，每个进程在第一次写日志时启动自己的后台线程。
+    """
+
+    def __init__(self, handlers: list[logging.Handler]):
+        super().__init__(queue.SimpleQueue())
+        self.handlers = handlers
+        self._lock = threading.Lock()
+        self._pid = None
+        self._listener = None
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 消息在后台线程中格式化，不在请求线程中拼接字符串
+        return record
+
+    def emit(self, record: logging.LogRecord):
+        if self._pid != os.getpid():
+            self._start()
+        super().emit(record)
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # 父进程的队列和线程不能在子进程中使用
+            self.queue = queue.SimpleQueue()
+            self._listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        """写完队列中剩余的日志"""
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+                self._listener = None
+                self._pid = None
+
+
 class LogHandler(logging.Logger):
 
-    def __init__(self, name, level=INFO, stream=True, file=True):
+    def __init__(self, name, level=INFO, stream=True, file=True, json_format=False):
         self.name = name
         self.level = level
+        self.json_format = json_format
+        self.handlers_to_write = []
         logging.Logger.__init__(self, self.name, level=level)
         if stream:
             self.__setStreamHandler__()
         if file:
             self.__setFileHandler__()
+        self.queue_handler = AsyncQueueHandler(self.handlers_to_write)
+        self.addHandler(self.queue_handler)
+        atexit.register(self.queue_handler.stop)
+
+    def __formatter__(self) -> logging.Formatter:
+        if self.json_format:
+            return JsonFormatter()
+        return logging.Formatter(LOG_LINE_FORMAT, datefmt=LOG_DATE_FORMAT)
 
     def __setFileHandler__(self, level=None):
         """
@@ -47,33 +147,31 @@ class LogHandler(logging.Logger):
             file_handler.setLevel(self.level)
         else:
             file_handler.setLevel(level)
-        formatter = logging.Formatter(
-            '%(asctime)s.%(msecs)03d %(levelname)s | [%(threadName)s] %(name)s [%(lineno)d] | %(filename)s %(funcName)s | %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S')
-
-        file_handler.setFormatter(formatter)
+        file_handler.setFormatter(self.__formatter__())
         self.file_handler = file_handler
-        self.addHandler(file_handler)
+        # 由后台线程写入
+        self.handlers_to_write.append(file_handler)
 
     def __setStreamHandler__(self, level=None):
 
         stream_handler = logging.StreamHandler()
-        formatter = logging.Formatter(
-            '%(asctime)s.%(msecs)03d %(levelname)s | [%(threadName)s] %(name)s [%(lineno)d] | %(filename)s %(funcName)s | %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S')
-        stream_handler.setFormatter(formatter)
+        stream_handler.setFormatter(self.__formatter__())
 
         if not level:
             stream_handler.setLevel(self.level)
         else:
             stream_handler.setLevel(level)
-        self.addHandler(stream_handler)
+        self.handlers_to_write.append(stream_handler)
 
     def resetName(self, name):
         self.name = name
-        self.removeHandler(self.file_handler)
+        # 先写完队列中的日志，后台线程在下一条日志时以新的文件重新启动
+        self.queue_handler.stop()
+        self.handlers_to_write.remove(self.file_handler)
+        self.file_handler.close()
         self.__setFileHandler__()
 
+
 debug = True if os.environ.get('DEBUG', 'False').lower() == 'true' else False
 
 log_level = os.environ.get('LOG_LEVEL', "")
@@ -91,8 +189,11 @@ elif log_level.lower() == 'debug':
 else:
     log_level = INFO if not debug else DEBUG
 
+# text or json
+log_format = os.environ.get('LOG_FORMAT', 'text').lower()
+
 project_name = 'chat'
-log = LogHandler(project_name, level=log_level)
+log = LogHandler(project_name, level=log_level, json_format=log_format == 'json')
 
 if __name__ == '__main__':
     log.info('this is a test msg')
@@ -0,0 +1,71 @@
+import os
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+
+# Prometheus metrics of the bot.
+# With gunicorn the metrics of all the worker processes are written to PROMETHEUS_MULTIPROC_DIR,
+# and aggregated when they are scraped, see gunicorn_config.py.
+
+_LLM_BUCKETS = (1, 2.5, 5, 10, 20, 30, 60, 120, 180, 300, 600)
+_REVIEW_BUCKETS = (5, 10, 30, 60, 120, 300, 600, 900, 1800, 3600)
+
+WEBHOOK_LATENCY = Histogram(
+    "crbot_webhook_latency_seconds", "Time to answer a GitLab webhook request"
+)
+WEBHOOK_EVENTS = Counter(
+    "crbot_webhook_events_total", "GitLab webhook events by the result, accepted or the reason to filter them",
+    ["result"]
+)
+REVIEW_DURATION = Histogram(
+    "crbot_review_duration_seconds", "Time from the start of a review job to its end, by outcome",
+    ["outcome"], buckets=_REVIEW_BUCKETS
+)
+REVIEW_OUTCOMES = Counter(
+    "crbot_review_outcomes_total", "Merge requests labeled done, failed or busy by the bot, or skipped",
+    ["outcome"]
+)
+LLM_REQUEST_SECONDS = Histogram(
+    "crbot_llm_request_seconds", "Latency of an LLM request including the wait for a slot, by outcome",
+    ["outcome"], buckets=_LLM_BUCKETS
+)
+LLM_TOKENS = Counter(
+    "crbot_llm_tokens_total", "Prompt and completion tokens of the LLM requests",
+    ["kind"]
+)
+GITLAB_REQUEST_SECONDS = Histogram(
+    "crbot_gitlab_request_seconds", "Latency of a GitLab API request by endpoint",
+    ["endpoint"]
+)
+GITLAB_ERRORS = Counter(
+    "crbot_gitlab_errors_total", "GitLab API requests failed with an error status or a connection error, by endpoint",
+    ["endpoint"]
+)
+
+
+def registry(*collectors) -> CollectorRegistry:
+    """
+    Registry to scrape, with the metrics of all the processes if the multiprocess mode is on
+    :param collectors: collectors computed at scrape time, e.g. the queue depth
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        scrape = CollectorRegistry()
+        multiprocess.MultiProcessCollector(scrape)
+    else:
+        scrape = CollectorRegistry()
+        scrape.register(_DefaultCollector())
+    for collector in collectors:
+        scrape.register(collector)
+    return scrape
+
+
+def render(scrape: CollectorRegistry) -> tuple[bytes, str]:
+    return generate_latest(scrape), CONTENT_TYPE_LATEST
+
+
+class _DefaultCollector:
+    """The metrics of the current process, when there is only one process"""
+
+    def collect(self):
+        return REGISTRY.collect()
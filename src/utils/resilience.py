@@ -0,0 +1,202 @@
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, TypeVar
+
+from utils.logger import log
+from utils.tracing import span
+
+
+T = TypeVar("T")
+
+# Circuit breaker states
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """The backend is down, the call fails at once without reaching it"""
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        # seconds until the circuit lets a probe through
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of a backend in the current process.
+    It opens after consecutive failures, so the calls fail at once while the backend is down.
+    After the recovery time one call is let through as a probe, it closes the circuit if it succeeds.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, recovery_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._rejected = 0
+
+    @property
+    def available(self) -> bool:
+        """
+        Whether a call may reach the backend now, without taking the probe of a half open circuit
+        """
+        with self._lock:
+            return self._state == CLOSED or (
+                self._state == OPEN and time.monotonic() - self._opened_at >= self.recovery_seconds
+            )
+
+    @property
+    def retry_after(self) -> float:
+        """
+        Seconds until a call may reach the backend, 0 if it may now
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return 0.0
+            return max(0.0, self._opened_at + self.recovery_seconds - time.monotonic())
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError if the call must not reach the backend
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.recovery_seconds:
+                self._state = HALF_OPEN
+                log.info(f"Circuit of {self.name} is half open, probe the backend")
+                return
+            self._rejected += 1
+            retry_after = max(0.0, self._opened_at + self.recovery_seconds - time.monotonic())
+        raise CircuitOpenError(f"Circuit of {self.name} is open, the backend is down", retry_after)
+
+    def record_success(self):
+        with self._lock:
+            closed = self._state != CLOSED
+            self._state = CLOSED
+            self._failures = 0
+        if closed:
+            log.info(f"Circuit of {self.name} is closed, the backend is recovered")
+
+    def record_ignored(self):
+        """
+        The call failed by its own fault, e.g. a bad request, it tells nothing about the backend.
+        The failures are kept, and the probe of a half open circuit is given back to the next call.
+        """
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._state = OPEN
+                self._opened_at = time.monotonic() - self.recovery_seconds
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == CLOSED and self._failures < self.failure_threshold:
+                return
+            self._state = OPEN
+            self._opened_at = time.monotonic()
+        log.error(f"Circuit of {self.name} is open for {self.recovery_seconds:.0f}s "
+                  f"after {self._failures} consecutive failures")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self._state, "failures": self._failures, "rejected": self._rejected}
+
+
+class RetryBudget:
+    """
+    Retries and backoff time that all the calls of one review job may spend together
+    """
+
+    def __init__(self, retries: int, seconds: float):
+        self.retries = retries
+        self.seconds = seconds
+        self._lock = threading.Lock()
+
+    def spend(self, delay: float) -> bool:
+        """
+        Take a retry and its backoff from the budget
+        :return: False if the budget is exhausted
+        """
+        with self._lock:
+            if self.retries <= 0 or self.seconds < delay:
+                return False
+            self.retries -= 1
+            self.seconds -= delay
+            return True
+
+
+_budget: contextvars.ContextVar[RetryBudget | None] = contextvars.ContextVar("retry_budget", default=None)
+
+
+@contextmanager
+def retry_budget(retries: int, seconds: float) -> Iterator[RetryBudget]:
+    """
+    Share a retry budget with all the calls in the context.
+    Threads started in the context get it by running in a copy of the context, see contextvars.copy_context.
+    """
+    budget = RetryBudget(retries, seconds)
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the n-th retry waits a random time up to min(cap, base * 2^n)
+    """
+    attempts: int
+    base_seconds: float
+    cap_seconds: float
+
+    def backoff(self, retry: int) -> float:
+        return random.uniform(0, min(self.cap_seconds, self.base_seconds * 2 ** retry))
+
+
+def call_with_retry(func: Callable[[], T], breaker: CircuitBreaker, policy: RetryPolicy,
+                    retryable: Callable[[Exception], bool]) -> T:
+    """
+    Call the backend through its circuit breaker, and retry the retryable errors
+    within the policy and the retry budget of the current job
+    :param func: the call
+    :param breaker: circuit breaker of the backend
+    :param policy: attempts and backoff
+    :param retryable: whether an error is transient, only the transient errors count as backend failures
+    """
+    retry = 0
+    while True:
+        breaker.before_call()
+        try:
+            result = func()
+        except Exception as e:
+            if not retryable(e):
+                # e.g. a bad request, it must not close the circuit
+                breaker.record_ignored()
+                raise
+            breaker.record_failure()
+            if retry + 1 >= policy.attempts:
+                raise
+            delay = policy.backoff(retry)
+            budget = _budget.get()
+            if budget is not None and not budget.spend(delay):
+                log.warning(f"Retry budget of the job is exhausted, give up: {e}")
+                raise
+            retry += 1
+            log.warning(f"Call to {breaker.name} failed, retry {retry} in {delay:.1f}s: {e}")
+            with span("retry.sleep", backend=breaker.name, retry=retry):
+                time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
@@ -0,0 +1,98 @@
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent.parent
+SRC_ROOT = ROOT / 'src'
+
+sys.path.append(ROOT.as_posix())
+sys.path.append(SRC_ROOT.as_posix())
+
+
+import pytest
+
+from utils.resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    call_with_retry,
+    retry_budget
+)
+
+
+NO_WAIT = RetryPolicy(attempts=3, base_seconds=0, cap_seconds=0)
+
+
+class Transient(Exception):
+    pass
+
+
+def failing(times: int, exception: Exception):
+    calls = []
+
+    def call():
+        calls.append(1)
+        if len(calls) <= times:
+            raise exception
+        return len(calls)
+    return call, calls
+
+
+def retryable(e: Exception) -> bool:
+    return isinstance(e, Transient)
+
+
+def test_transient_error_is_retried():
+    call, _ = failing(2, Transient())
+    assert call_with_retry(call, CircuitBreaker("test", 5, 60), NO_WAIT, retryable) == 3
+
+
+def test_other_error_is_not_retried():
+    call, calls = failing(1, ValueError())
+    with pytest.raises(ValueError):
+        call_with_retry(call, CircuitBreaker("test", 5, 60), NO_WAIT, retryable)
+    assert len(calls) == 1
+
+
+def test_retry_budget_is_shared():
+    breaker = CircuitBreaker("test", 100, 60)
+    with retry_budget(retries=1, seconds=60):
+        call, _ = failing(1, Transient())
+        call_with_retry(call, breaker, NO_WAIT, retryable)
+        call, calls = failing(1, Transient())
+        with pytest.raises(Transient):
+            call_with_retry(call, breaker, NO_WAIT, retryable)
+        assert len(calls) == 1
+
+
+def test_circuit_opens_and_recovers():
+    breaker = CircuitBreaker("test", 2, 0.05)
+    call, _ = failing(2, Transient())
+    with pytest.raises(Transient):
+        call_with_retry(call, breaker, RetryPolicy(2, 0, 0), retryable)
+    assert breaker.stats()["state"] == OPEN
+    assert not breaker.available and breaker.retry_after > 0
+    with pytest.raises(CircuitOpenError):
+        call_with_retry(call, breaker, NO_WAIT, retryable)
+
+    time.sleep(0.06)
+    assert breaker.available
+    assert call_with_retry(call, breaker, NO_WAIT, retryable) == 3
+    assert breaker.stats()["state"] == CLOSED
+
+
+def test_other_error_does_not_close_a_half_open_circuit():
+    breaker = CircuitBreaker("test", 1, 0.05)
+    with pytest.raises(Transient):
+        call_with_retry(failing(1, Transient())[0], breaker, RetryPolicy(1, 0, 0), retryable)
+    time.sleep(0.06)
+    with pytest.raises(ValueError):
+        call_with_retry(failing(1, ValueError())[0], breaker, NO_WAIT, retryable)
+    assert breaker.stats()["state"] == OPEN
+    # the probe is given back to the next call
+    assert breaker.available
+    breaker.before_call()
+    assert breaker.stats()["state"] == HALF_OPEN
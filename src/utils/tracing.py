@@ -0,0 +1,245 @@
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator
+
+import requests
+
+from config.config import otlp_endpoint, otlp_service_name
+from utils.logger import log
+
+
+# Spans waiting to be exported, the newest are dropped if the collector is too slow
+EXPORT_QUEUE_SIZE = 2048
+EXPORT_BATCH_SIZE = 256
+EXPORT_TIMEOUT_SECONDS = 5
+
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+
+def _new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    name: str
+    start_ns: int
+    end_ns: int = 0
+    attributes: dict = field(default_factory=dict)
+    error: str | None = None
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1e6
+
+
+class _Trace:
+    """Finished spans of a trace, the spans may end in different threads"""
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+
+_current: contextvars.ContextVar[tuple[_Trace, Span] | None] = contextvars.ContextVar("trace", default=None)
+
+
+def current_trace_id() -> str | None:
+    current = _current.get()
+    return current[0].trace_id if current is not None else None
+
+
+@contextmanager
+def trace(name: str, trace_id: str | None = None, summary: bool = True, **attributes) -> Iterator[Span]:
+    """
+    Start a trace in the current context, the spans in the context and in its copies belong to it.
+    When it ends, a JSON line with the time of each stage is logged, and the spans are exported.
+    :param trace_id: continue a trace started elsewhere, e.g. by the webhook of a queued review
+    :param summary: log the summary line
+    """
+    root = Span(trace_id or new_trace_id(), _new_span_id(), None, name, time.time_ns(), attributes=attributes)
+    current = _Trace(root.trace_id)
+    token = _current.set((current, root))
+    try:
+        yield root
+    except BaseException as e:
+        root.error = str(e) or type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        root.end_ns = time.time_ns()
+        current.add(root)
+        if summary:
+            log.info(json.dumps(summarize(root, current.spans), ensure_ascii=False))
+        otlp_exporter.export(current.spans)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span | None]:
+    """
+    Time a stage of the current trace, it does nothing outside of a trace.
+    A span must start and end in the same context, it must not be held across the yield of a generator.
+    :return: the span to add attributes to, None outside of a trace
+    """
+    current = _current.get()
+    if current is None:
+        yield None
+        return
+    owner, parent = current
+    child = Span(owner.trace_id, _new_span_id(), parent.span_id, name, time.time_ns(), attributes=attributes)
+    token = _current.set((owner, child))
+    try:
+        yield child
+    except BaseException as e:
+        child.error = str(e) or type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        child.end_ns = time.time_ns()
+        owner.add(child)
+
+
+def record_span(name: str, start: float, end: float, **attributes):
+    """
+    Add a stage timed elsewhere to the current trace, e.g. the time in queue
+    :param start: time.monotonic() at the start
+    :param end: time.monotonic() at the end
+    """
+    current = _current.get()
+    if current is None or end < start:
+        return
+    owner, parent = current
+    offset = time.time_ns() - time.monotonic_ns()
+    owner.add(Span(
+        owner.trace_id, _new_span_id(), parent.span_id, name,
+        int(start * 1e9) + offset, int(end * 1e9) + offset, attributes=attributes
+    ))
+
+
+def summarize(root: Span, spans: list[Span]) -> dict:
+    """
+    Summary of a trace: its total time, and the count and the time of each stage.
+    The stages may overlap, e.g. the LLM calls of the chunks run in parallel.
+    """
+    stages = {}
+    for item in spans:
+        if item is root:
+            continue
+        stage = stages.setdefault(item.name, {"count": 0, "ms": 0.0, "errors": 0})
+        stage["count"] += 1
+        stage["ms"] += item.duration_ms
+        stage["errors"] += int(item.error is not None)
+    for stage in stages.values():
+        stage["ms"] = round(stage["ms"], 1)
+    return {
+        "trace": root.name,
+        "trace_id": root.trace_id,
+        **root.attributes,
+        "duration_ms": round(root.duration_ms, 1),
+        "error": root.error,
+        "stages": stages,
+    }
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(item: Span) -> dict:
+    otlp = {
+        "traceId": item.trace_id,
+        "spanId": item.span_id,
+        "name": item.name,
+        # internal
+        "kind": 1,
+        "startTimeUnixNano": str(item.start_ns),
+        "endTimeUnixNano": str(item.end_ns),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in item.attributes.items()],
+        # ok or error
+        "status": {"code": 2, "message": item.error} if item.error is not None else {"code": 1},
+    }
+    if item.parent_id is not None:
+        otlp["parentSpanId"] = item.parent_id
+    return otlp
+
+
+class OtlpExporter:
+    """
+    Send the spans to an OpenTelemetry collector by OTLP/HTTP with JSON encoding, in a background thread.
+    It does nothing if no endpoint is set.
+    """
+
+    def __init__(self, endpoint: str, service_name: str):
+        self.url = f"{endpoint.rstrip('/')}/v1/traces" if endpoint else None
+        self.service_name = service_name
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue: queue.Queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self._dropped = 0
+
+    def export(self, spans: list[Span]):
+        if self.url is None:
+            return
+        self._ensure_sender()
+        for item in spans:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._dropped += 1
+
+    def _ensure_sender(self):
+        # the thread is not inherited by the forked gunicorn workers
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._send, name="otlp-exporter", daemon=True).start()
+
+    def _send(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < EXPORT_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            payload = {"resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": self.service_name}},
+                ]},
+                "scopeSpans": [{"scope": {"name": "crbot"}, "spans": [_otlp_span(item) for item in batch]}],
+            }]}
+            try:
+                response = requests.post(self.url, json=payload, timeout=EXPORT_TIMEOUT_SECONDS)
+                if response.status_code >= 400:
+                    log.warning(f"Export {len(batch)} spans failed, status code: {response.status_code}")
+            except requests.RequestException as e:
+                log.warning(f"Export {len(batch)} spans failed: {e}")
+            if self._dropped:
+                log.warning(f"Drop {self._dropped} spans, the collector is too slow")
+                self._dropped = 0
+
+
+otlp_exporter = OtlpExporter(otlp_endpoint, otlp_service_name)